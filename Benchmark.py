@@ -0,0 +1,573 @@
+# Benchmark suite for Vares Browser. Runs against a local HTTP/HTTPS server, no network needed:
+#   python Benchmark.py                      Run every benchmark and compare with the baseline
+#   python Benchmark.py --save-baseline      Run and store the results as the new baseline
+#   python Benchmark.py --only lex --scale 2 Run the benchmarks whose name contains "lex", with pages twice as big
+# Exits with status 1 when a benchmark is slower than the baseline by more than the tolerance.
+import gc
+import os
+import sys
+import json
+import time
+import gzip
+import random
+import shutil
+import platform
+import tempfile
+import threading
+import subprocess
+import statistics
+import tracemalloc
+import http.server
+import socketserver
+import ssl
+
+BENCH_DIR = tempfile.mkdtemp(prefix="vares_bench_")
+# Keep the benchmarks away from the user's cache and independent of a display
+os.environ["VARES_CACHE_DIR"] = os.path.join(BENCH_DIR, "cache")
+os.environ.setdefault("VARES_FONT_BACKEND", "headless")
+
+import Browser
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+DEFAULT_TOLERANCE = 0.25  # Allowed slowdown of the median before a benchmark counts as a regression
+MIN_TIME = 0.5  # Seconds each benchmark runs for, after warming up
+MIN_ITERATIONS = 5
+WARMUP_ITERATIONS = 2
+SERVER_CHUNK_SIZE = 4096  # Chunk size of Transfer-Encoding: chunked responses
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "browser", "layout", "canvas", "socket", "render", "vares", "engineering"]
+
+def synthetic_page(size, seed=0):
+    # Deterministic HTML of about size bytes, mixing text, formatting tags and entities
+    rng = random.Random(seed)
+    parts = ["<!DOCTYPE html><html><head><title>Benchmark page</title></head><body>\n"]
+    length = len(parts[0])
+    while length < size:
+        words = [rng.choice(WORDS) for _ in range(rng.randint(20, 60))]
+        for i in range(0, len(words), 7):
+            tag = rng.choice(["b", "i", "small", "big"])
+            words[i] = f"<{tag}>{words[i]}</{tag}>"
+        paragraph = "<p>" + " ".join(words) + " &amp; &lt;more&gt; &#8212; text</p>\n"
+        if rng.random() < 0.1:
+            paragraph = "<h1>" + " ".join(words[:5]) + "</h1>\n" + paragraph
+        parts.append(paragraph)
+        length += len(paragraph)
+    parts.append("</body></html>\n")
+    return "".join(parts).encode("utf8")
+
+class BenchHandler(http.server.BaseHTTPRequestHandler):
+    # Paths: /page/SIZE, /close/SIZE, /chunked/SIZE, /gzip/SIZE, /redirect/HOPS/SIZE (no-store 301s),
+    # /moved/HOPS/SIZE (cacheable 301s), /cached/SIZE (max-age), /cached_gzip/SIZE (max-age, gzip)
+    # and /etag/SIZE (always revalidated, answers 304)
+    protocol_version = "HTTP/1.1"  # Keep-alive unless the response says otherwise
+    disable_nagle_algorithm = True  # Headers and body are separate writes; don't let them wait on delayed ACKs
+    pages = {}  # (size, gzipped) -> body, generated once
+
+    def log_message(self, *args):
+        pass
+
+    def page(self, size, gzipped=False):
+        body = self.pages.get((size, gzipped))
+        if body is None:
+            body = gzip.compress(self.page(size), compresslevel=6) if gzipped else synthetic_page(size)
+            self.pages[(size, gzipped)] = body
+        return body
+
+    def do_GET(self):
+        parts = self.path.split("?", 1)[0].strip("/").split("/")  # A query only makes the URL distinct
+        try:
+            kind, numbers = parts[0], [int(part) for part in parts[1:]]
+        except ValueError:
+            kind, numbers = None, []
+        if kind in ("page", "close", "chunked", "gzip", "cached", "cached_gzip", "etag") and len(numbers) == 1:
+            body = self.page(numbers[0], kind in ("gzip", "cached_gzip"))
+        elif kind in ("redirect", "moved") and len(numbers) == 2:
+            hops, size = numbers
+            target = f"/{kind}/{hops - 1}/{size}" if hops > 1 else f"/page/{size}"
+            self.send_response(301)
+            self.send_header("Location", target)
+            if kind == "redirect":
+                self.send_header("Cache-Control", "no-store")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        else:
+            self.send_error(404)
+            return
+        etag = '"bench-%d"' % len(body)
+        if kind == "etag":
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "max-age=0")
+                self.end_headers()
+                return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        if kind in ("cached", "cached_gzip"):
+            self.send_header("Cache-Control", "max-age=3600")
+        elif kind == "etag":
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "max-age=0")
+        else:
+            self.send_header("Cache-Control", "no-store")
+        if kind == "close":
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        if kind in ("gzip", "cached_gzip"):
+            self.send_header("Content-Encoding", "gzip")
+        if kind == "chunked":
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(body), SERVER_CHUNK_SIZE):
+                chunk = body[i:i + SERVER_CHUNK_SIZE]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class BenchServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+def start_server(scheme, cert_files=None):
+    # Serve BenchHandler on a free local port from a background thread
+    server = BenchServer(("127.0.0.1", 0), BenchHandler)
+    server.scheme = scheme
+    if scheme == "https":
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*cert_files)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_certificate():
+    # Self-signed certificate for 127.0.0.1, made with the openssl command line tool.
+    # Returns (cert file, key file), or None when openssl is not available
+    cert_file = os.path.join(BENCH_DIR, "cert.pem")
+    key_file = os.path.join(BENCH_DIR, "key.pem")
+    try:
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-keyout", key_file, "-out", cert_file, "-subj", "/CN=127.0.0.1",
+             "-addext", "subjectAltName=IP:127.0.0.1"],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return cert_file, key_file
+
+def reset_network_state():
+    # Forget cached responses and pooled sockets so each request really goes to the server
+    Browser.cached_responses.clear()
+    Browser.connection_pool.close_all()
+
+def run_benchmark(operation, min_time=MIN_TIME, setup=None):
+    # Time operation() repeatedly; setup(), if given, runs untimed before each call.
+    # Returns the list of durations in seconds
+    for _ in range(WARMUP_ITERATIONS):
+        if setup:
+            setup()
+        operation()
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < MIN_ITERATIONS or time.perf_counter() < deadline:
+        if setup:
+            setup()
+        start = time.perf_counter()
+        operation()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def summarize(samples, size=None):
+    samples = sorted(samples)
+    result = {
+        "iterations": len(samples),
+        "median": statistics.median(samples),
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "min": samples[0],
+    }
+    result["ops_per_second"] = 1 / result["median"] if result["median"] else 0.0
+    if size:
+        result["mb_per_second"] = size / result["median"] / 1e6 if result["median"] else 0.0
+    return result
+
+def request_benchmarks(base, scheme, scale):
+    # (name, operation, setup, bytes per operation) for URL.request against the local server
+    page = int(64 * 1024 * scale)
+    big = int(256 * 1024 * scale)
+    def get(path):
+        return lambda: Browser.URL(base + path).request()
+    def fresh_request():
+        Browser.cached_responses.clear()
+    def new_connection():
+        reset_network_state()
+    small = int(8 * 1024 * scale)
+    paths = [f"/page/{small}?{i}" for i in range(8)]
+    def many(pipeline):
+        return lambda: Browser.URL(base + "/").request_many(paths, pipeline=pipeline)
+    def concurrent(path, count=8):
+        # The same URL requested by several threads at once, fetched only once
+        def operation():
+            threads = [threading.Thread(target=Browser.URL(base + path).request) for _ in range(count)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return operation
+    benchmarks = [
+        (f"request.{scheme}.keepalive", get(f"/page/{page}"), fresh_request, page),
+        (f"request.{scheme}.new_connection", get(f"/page/{page}"), new_connection, page),
+        (f"request.{scheme}.chunked", get(f"/chunked/{big}"), fresh_request, big),
+        (f"request.{scheme}.gzip", get(f"/gzip/{big}"), fresh_request, big),
+        (f"request.{scheme}.redirect_chain", get(f"/redirect/3/{page}"), fresh_request, page),
+        (f"request.{scheme}.redirect_memo", get(f"/moved/3/{page}"), None, page),
+        (f"request.{scheme}.pipeline8", many(True), fresh_request, small * 8),
+        (f"request.{scheme}.parallel8", many(False), fresh_request, small * 8),
+        (f"request.{scheme}.coalesced8", concurrent(f"/page/{big}"), fresh_request, big),
+    ]
+    if scheme == "http":
+        # Cache paths don't depend on the transport, so they only run once
+        benchmarks += [
+            ("request.http.close", get(f"/close/{page}"), fresh_request, page),
+            ("request.http.cache_hit", get(f"/cached/{page}"), None, page),
+            ("request.http.disk_cache_hit", get(f"/cached/{page}"), fresh_request, page),
+            ("request.http.cache_hit_gzip", get(f"/cached_gzip/{page}"), None, page),
+            ("request.http.revalidate", get(f"/etag/{page}"), None, page),
+        ]
+    return benchmarks
+
+def lex_benchmarks(scale):
+    benchmarks = []
+    for size in (int(64 * 1024 * scale), int(1024 * 1024 * scale)):
+        html = synthetic_page(size).decode("utf8")
+        benchmarks.append((f"lex.{size // 1024}k", lambda html=html: Browser.lex(html), None, size))
+    return benchmarks
+
+def write_page_file(size):
+    # A synthetic page on disk, for the file:// benchmarks
+    path = os.path.join(BENCH_DIR, f"page_{size}.html")
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(synthetic_page(size))
+    return path
+
+def stream_file(path):
+    # Stream a local file through the incremental lexer the way a progressive load
+    # does, dropping the tokens
+    lexer = Browser.Lexer(partial_text=True)
+    Browser.URL(f"file://{path}").request(on_chunk=lexer.feed)
+    lexer.close()
+
+def file_benchmarks(scale):
+    size = int(16 * 1024 * 1024 * scale)
+    path = write_page_file(size)
+    return [
+        (f"file.read.{size // 1024}k", lambda: Browser.URL(f"file://{path}").request(), None, size),
+        (f"file.stream_lex.{size // 1024}k", lambda: stream_file(path), None, size),
+    ]
+
+def layout_benchmarks(scale):
+    size = int(256 * 1024 * scale)
+    tokens = Browser.lex(synthetic_page(size).decode("utf8"))
+    def cold():
+        Browser.text_measurer = Browser.TextMeasurer()
+        Browser.block_cache.clear()
+    def fresh():
+        Browser.block_cache.clear()
+    # A reload where one paragraph in the middle changed: only its block is laid out again
+    edited = list(tokens)
+    middle = next(i for i in range(len(edited) // 2, len(edited)) if isinstance(edited[i], Browser.Text))
+    edits = iter(range(1 << 30))
+    def edit():
+        edited[middle] = Browser.Text(tokens[middle].text + f" edit{next(edits)}")
+    backend = "headless" if isinstance(Browser.font_backend, Browser.HeadlessFontBackend) else "tk"
+    return [
+        (f"layout.{backend}.{size // 1024}k", lambda: Browser.Layout(tokens, 800, False), None, size),
+        (f"layout.{backend}.{size // 1024}k.cold_measure", lambda: Browser.Layout(tokens, 800, False), cold, size),
+        (f"layout.{backend}.{size // 1024}k.first_screen", lambda: Browser.Layout(tokens, 800, False, lazy_height=600 + Browser.LAZY_LAYOUT_MARGIN), None, None),
+        (f"layout.{backend}.{size // 1024}k.memoized_first", lambda: Browser.Layout(tokens, 800, False, memoize=True), fresh, size),
+        (f"layout.{backend}.{size // 1024}k.relayout", lambda: Browser.Layout(tokens, 800, False, memoize=True), None, size),
+        (f"layout.{backend}.{size // 1024}k.edited_reload", lambda: Browser.Layout(edited, 800, False, memoize=True), edit, size),
+    ]
+
+def render_benchmarks(scale):
+    # Batch rendering of a corpus of page files, on one process and on every core;
+    # pool startup is included, as in a corpus run
+    pages = 32
+    size = int(64 * 1024 * scale)
+    corpus = []
+    for seed in range(pages):
+        path = os.path.join(BENCH_DIR, f"corpus_{size}_{seed}.html")
+        with open(path, "wb") as f:
+            f.write(synthetic_page(size, seed))
+        corpus.append(path)
+    def render(processes):
+        with open(os.devnull, "w", encoding="utf8") as output:
+            failed = Browser.render_batch(corpus, output, processes=processes, report=None)
+        assert not failed
+    benchmarks = [(f"render.batch.{pages}x{size // 1024}k.processes1", lambda: render(1), None, pages * size)]
+    if (os.cpu_count() or 1) > 1:
+        benchmarks.append((f"render.batch.{pages}x{size // 1024}k.processes{os.cpu_count()}", lambda: render(os.cpu_count()), None, pages * size))
+    return benchmarks
+
+def import_time(module="Browser"):
+    # Import module in a fresh interpreter with -X importtime. Returns the seconds the
+    # import took and {module it imports directly: seconds}
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)  # Let the warm-up write the .pyc, so compiling isn't timed
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=os.path.dirname(os.path.abspath(Browser.__file__)), env=env, capture_output=True, text=True, check=True).stderr
+    children = {}
+    for line in output.splitlines():
+        fields = line.split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        seconds = int(fields[1]) / 1e6
+        name = fields[2][1:]
+        if not name.startswith(" "):
+            if name == module:
+                return seconds, children
+            children = {}  # Imports of an earlier top-level module, e.g. site
+        elif not name.startswith("   "):
+            children[name.strip()] = seconds
+    raise RuntimeError(f"No import time reported for {module}")
+
+def startup_benchmarks(min_time=MIN_TIME):
+    # Cold start: the import of Browser as -X importtime reports it, with its slowest
+    # direct imports, and the default page shown from its snapshot against loaded and
+    # laid out (the first start, or after the file or the fonts changed)
+    results = {}
+    for _ in range(WARMUP_ITERATIONS):
+        import_time()
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < MIN_ITERATIONS or time.perf_counter() < deadline:
+        seconds, children = import_time()
+        samples.append(seconds)
+    results["startup.import"] = summarize(samples)
+    results["startup.import"]["slowest_imports"] = {name: round(seconds * 1000, 3) for name, seconds in sorted(children.items(), key=lambda item: -item[1])[:5]}
+    path = os.path.join(os.path.dirname(os.path.abspath(Browser.__file__)), "Default.html")
+    snapshot_file = os.path.join(BENCH_DIR, "default_page.json")
+    def load():
+        # What Browser.layout_page does for an 800x600 window
+        url = Browser.URL(f"file:///{path}")
+        tokens = Browser.lex(url.request(), url.view_source, url.right_to_left_text)
+        layout = Browser.Layout(tokens, 800, False, max_height=600)
+        if layout.biggest_y + Browser.VSTEP > 600:
+            layout = Browser.Layout(tokens, 800 - Browser.SCROLLBAR_WIDTH, False, lazy_height=600 + Browser.LAZY_LAYOUT_MARGIN)
+        return tokens, layout
+    def cold():
+        Browser.text_measurer = Browser.TextMeasurer()
+        Browser.block_cache.clear()
+    def snapshot():
+        url = Browser.URL(f"file:///{path}")
+        layout = Browser.load_snapshot(snapshot_file, path, 800, 600, False)
+        Browser.lex(url.request(), url.view_source, url.right_to_left_text)  # Browser.load_default keeps the tokens too
+        assert layout is not None
+    Browser.save_snapshot(snapshot_file, path, 800, 600, False, load()[1])
+    for name, operation, setup in (("startup.default_page.load", load, cold), ("startup.default_page.snapshot", snapshot, cold)):
+        results[name] = summarize(run_benchmark(operation, min_time, setup))
+    return results
+
+def memory_benchmarks(scale):
+    # Bytes allocated per token by lex and per word by a Layout's display list, and
+    # per word by the blocks a memoizing layout records on top of its display list,
+    # measured with tracemalloc. The measure cache is warmed first so it isn't counted
+    html = synthetic_page(int(1024 * 1024 * scale)).decode("utf8")
+    Browser.Layout(Browser.lex(html), 800, False)
+    Browser.block_cache.clear()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        tokens = Browser.lex(html)
+        lexed = tracemalloc.get_traced_memory()[0]
+        layout = Browser.Layout(tokens, 800, False)
+        laid_out = tracemalloc.get_traced_memory()[0]
+        del layout
+        gc.collect()
+        before_memoized = tracemalloc.get_traced_memory()[0]
+        layout = Browser.Layout(tokens, 800, False, memoize=True)
+        memoized = tracemalloc.get_traced_memory()[0]
+    finally:
+        Browser.block_cache.clear()
+        tracemalloc.stop()
+    # Peak memory of streaming a file through the lexer, per byte of the file
+    size = int(16 * 1024 * 1024 * scale)
+    path = write_page_file(size)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        stream_file(path)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        "memory.file.stream_peak_per_byte": {"bytes": peak / size, "count": size},
+        "memory.lex.per_token": {"bytes": (lexed - start) / len(tokens), "count": len(tokens)},
+        "memory.layout.per_word": {"bytes": (laid_out - lexed) / len(layout.display_list), "count": len(layout.display_list)},
+        "memory.layout.memoized_blocks_per_word": {"bytes": (memoized - before_memoized - (laid_out - lexed)) / len(layout.display_list), "count": len(layout.display_list)},
+    }
+
+def draw_benchmarks(scale):
+    # Browser.draw needs a Tk window, so these are skipped without a display
+    if Browser.tkinter is None:
+        return [], "tkinter is not installed"
+    try:
+        browser = Browser.Browser(False)
+    except Browser.tkinter.TclError as e:
+        return [], f"no display ({e})"
+    browser.text = Browser.lex(synthetic_page(int(256 * 1024 * scale)).decode("utf8"))
+    browser.layout_page()
+    browser.window.update()
+    max_scroll = max(0, browser.biggest_y + Browser.VSTEP - browser.height)
+    def scroll():
+        # One frame of scrolling down, wrapping around at the end of the page
+        browser.scroll = browser.scroll + Browser.SCROLL_STEP if browser.scroll + Browser.SCROLL_STEP <= max_scroll else 0
+        browser.draw()
+        browser.window.update_idletasks()
+    def jump():
+        # A frame where every item is new, e.g. jumping to another part of the page
+        browser.scroll = (browser.scroll + browser.height * 3) % (max_scroll + 1)
+        browser.draw()
+        browser.window.update_idletasks()
+    return [("draw.scroll", scroll, None, None), ("draw.jump", jump, None, None)], None
+
+def run_suite(only=None, scale=1.0, min_time=MIN_TIME):
+    # Run the benchmarks and return {name: summary}; skipped groups are reported on stderr
+    results = {}
+    groups = []
+    http_server = start_server("http")
+    groups.append(lambda: request_benchmarks(f"http://127.0.0.1:{http_server.server_address[1]}", "http", scale))
+    cert_files = make_certificate()
+    if cert_files:
+        https_server = start_server("https", cert_files)
+        Browser.get_ssl_context().load_verify_locations(cert_files[0])  # Trust the self-signed certificate
+        groups.append(lambda: request_benchmarks(f"https://127.0.0.1:{https_server.server_address[1]}", "https", scale))
+    else:
+        print("Skipping https benchmarks: openssl is not available to make a certificate", file=sys.stderr)
+    groups.append(lambda: lex_benchmarks(scale))
+    groups.append(lambda: file_benchmarks(scale))
+    groups.append(lambda: layout_benchmarks(scale))
+    groups.append(lambda: render_benchmarks(scale))
+    for group in groups:
+        for name, operation, setup, size in group():
+            if only and not any(pattern in name for pattern in only):
+                continue
+            reset_network_state()
+            results[name] = summarize(run_benchmark(operation, min_time, setup), size)
+            print_result(name, results[name])
+    if not only or any("startup" in pattern for pattern in only):
+        for name, result in startup_benchmarks(min_time).items():
+            if not only or any(pattern in name for pattern in only):
+                results[name] = result
+                print_result(name, result)
+    for name, result in memory_benchmarks(scale).items():
+        if not only or any(pattern in name for pattern in only):
+            results[name] = result
+            print_result(name, result)
+    if not only or any("draw" in pattern for pattern in only):
+        benchmarks, reason = draw_benchmarks(scale)
+        if reason:
+            print(f"Skipping draw benchmarks: {reason}", file=sys.stderr)
+        for name, operation, setup, size in benchmarks:
+            if only and not any(pattern in name for pattern in only):
+                continue
+            results[name] = summarize(run_benchmark(operation, min_time, setup), size)
+            print_result(name, results[name])
+    http_server.shutdown()
+    Browser.connection_pool.close_all()
+    return results
+
+def metric(result):
+    # The number a result is compared on: median milliseconds, or bytes for memory results
+    return (result["bytes"], "B") if "bytes" in result else (result["median"] * 1000, "ms")
+
+def print_result(name, result):
+    if "bytes" in result:
+        print(f"{name:<40} {result['bytes']:9.1f} B     ({result['count']} items)")
+        return
+    throughput = f"{result['mb_per_second']:8.1f} MB/s" if "mb_per_second" in result else " " * 13
+    print(f"{name:<40} {result['median'] * 1000:9.3f} ms  p95 {result['p95'] * 1000:9.3f} ms  {result['ops_per_second']:9.1f} ops/s {throughput}  ({result['iterations']} runs)")
+    if "slowest_imports" in result:
+        print(" " * 41 + "slowest imports: " + ", ".join(f"{name} {ms:.1f} ms" for name, ms in result["slowest_imports"].items()))
+
+def compare(results, baseline, tolerance):
+    # Print the change against the baseline and return the names that regressed
+    regressions = []
+    print()
+    print(f"{'BENCHMARK':<40} {'BASELINE':>12} {'NOW':>12} {'CHANGE':>8}")
+    for name, result in results.items():
+        now, unit = metric(result)
+        previous = baseline["results"].get(name)
+        if previous is None:
+            print(f"{name:<40} {'-':>12} {now:9.3f} {unit:<2} {'new':>8}")
+            continue
+        before, _ = metric(previous)
+        change = now / before - 1
+        flag = ""
+        if change > tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<40} {before:9.3f} {unit:<2} {now:9.3f} {unit:<2} {change * 100:+7.1f}%{flag}")
+    return regressions
+
+def main(args):
+    save = False
+    baseline_file = BASELINE_FILE
+    tolerance = DEFAULT_TOLERANCE
+    scale = 1.0
+    min_time = MIN_TIME
+    only = []
+    while args:
+        arg = args.pop(0)
+        if arg == "--save-baseline":
+            save = True
+        elif arg == "--baseline":
+            baseline_file = args.pop(0)
+        elif arg == "--tolerance":
+            tolerance = float(args.pop(0))
+        elif arg == "--scale":
+            scale = float(args.pop(0))
+        elif arg == "--min-time":
+            min_time = float(args.pop(0))
+        elif arg == "--only":
+            only.append(args.pop(0))
+        else:
+            print(f"Unknown argument: {arg}", file=sys.stderr)
+            return 2
+    try:
+        results = run_suite(only, scale, min_time)
+    finally:
+        shutil.rmtree(BENCH_DIR, ignore_errors=True)
+    settings = {"scale": scale, "python": platform.python_version(), "machine": platform.machine(), "system": platform.system()}
+    if save:
+        # Keep the entries of benchmarks that were not run this time
+        baseline = {"settings": settings, "results": {}}
+        if os.path.exists(baseline_file):
+            with open(baseline_file, "r", encoding="utf8") as f:
+                baseline["results"] = json.load(f).get("results", {})
+        baseline["results"].update(results)
+        with open(baseline_file, "w", encoding="utf8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"\nBaseline saved to {baseline_file}")
+        return 0
+    if not os.path.exists(baseline_file):
+        print(f"\nNo baseline at {baseline_file}; run with --save-baseline to create one")
+        return 0
+    with open(baseline_file, "r", encoding="utf8") as f:
+        baseline = json.load(f)
+    if baseline.get("settings", {}).get("scale") != scale:
+        print(f"Baseline was recorded with --scale {baseline['settings'].get('scale')}, not {scale}", file=sys.stderr)
+        return 2
+    if baseline["settings"] != settings:
+        print(f"Warning: baseline was recorded on {baseline['settings']}, this run is {settings}", file=sys.stderr)
+    regressions = compare(results, baseline, tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed by more than {tolerance:.0%}: {', '.join(regressions)}", file=sys.stderr)
+        return 1
+    print(f"\nNo regressions beyond {tolerance:.0%}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,28 +1,972 @@
-import socket
-import ssl
 import sys
 import os
-import base64
 import time
-import gzip
-import tkinter
-import tkinter.font
+import zlib
+import errno
+import threading
+import json
+import collections
+import bisect
+import array
+import queue
+import codecs
+import re
+import html.entities
+import unicodedata
+import contextlib
+import importlib
+import atexit
+try:
+    import tkinter
+    import tkinter.font
+except ImportError:
+    tkinter = None  # Layout can still run headless with HeadlessFontBackend
 
 # Command to run: python Browser.py https://example.org
 
-# Global dictionaries to manage open sockets and cached responses
-open_sockets = {}  # Stores active socket connections for reuse
-cached_responses = {}  # Stores HTTP responses with their expiry times
+class DeferredModule:
+    # Stands in for a module until one of its attributes is used, then imports it and
+    # takes its place in this module's globals, so showing a local page doesn't pay for
+    # importing the network and compression modules
+    def __init__(self, name):
+        self.name = name  # A dotted name binds its top-level package, like import does
+
+    def __getattr__(self, attr):
+        importlib.import_module(self.name)
+        module = sys.modules[self.name.partition(".")[0]]
+        globals()[module.__name__] = module
+        return getattr(module, attr)
+
+socket = DeferredModule("socket")
+ssl = DeferredModule("ssl")
+select = DeferredModule("select")
+base64 = DeferredModule("base64")
+gzip = DeferredModule("gzip")
+mmap = DeferredModule("mmap")
+hashlib = DeferredModule("hashlib")
+asyncio = DeferredModule("asyncio")
+concurrent = DeferredModule("concurrent.futures")
+
+# Global dictionaries
 FONTS = {} # Global fonts dictionary, caches fonts to prevent repeatedly measuring then
 
 # GUI constants for layout and rendering
 HSTEP, VSTEP = 13, 18  # Horizontal and vertical spacing for text
 SCROLL_STEP = 100  # Pixels to scroll per step
 SCROLLBAR_WIDTH = 12  # Width of the scrollbar
+PROGRESSIVE_PAINT_INTERVAL = 0.05  # Minimum seconds between repaints while a page is downloading
+RESIZE_DELAY = 50  # Milliseconds without <Configure> events before relaying out
+LAYOUT_CACHE_SIZE = 4  # Layouts of the current page kept for recently used widths
+LOAD_POLL_INTERVAL = 16  # Milliseconds between checks for data from the network thread
+LOAD_POLL_BUDGET = 0.03  # Seconds of received data lexed per poll before the UI gets a turn
+LOAD_QUEUE_SIZE = 32  # Chunks a background load may get ahead of the UI before it waits
+LOAD_QUEUE_WAIT = 0.1  # Seconds a waiting load sleeps between checks for cancellation
+LAZY_LAYOUT_MARGIN = 600  # Pixels laid out below the viewport before a page is first drawn
+LAYOUT_SLICE = 0.008  # Seconds of layout done per idle callback while the rest of a page is laid out
+ESTIMATE_SAMPLES = 256  # Tokens sampled to estimate the height of a page still being laid out
+BLOCK_CACHE_ITEMS = 256 * 1024  # Words of laid out blocks kept for reuse by later layouts
+BLOCK_MAX_CHARS = 64 * 1024  # Longer blocks aren't memoized, so finding their end stays cheap
+RENDER_AHEAD = 8  # Pages per process rendered ahead of the one batch rendering waits to write
+PAGE_CACHE_SIZE = 64 * 1024 * 1024  # Estimated bytes of tokens and layouts kept for pages in the history
+TOKEN_BYTES = 82  # Approximate memory of a token besides its text (see Benchmark.py memory results)
+DISPLAY_ITEM_BYTES = 27  # Approximate memory of one word in a display list
+
+# Redirect control
+MAX_REDIRECTS = 10  # Maximum redirects followed by one request, to prevent loops
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+PERMANENT_REDIRECT_STATUSES = (301, 308)  # Remembered unless the server forbids it
+
+# Connection pool limits
+MAX_CONNECTIONS_PER_HOST = 6  # Maximum sockets (idle + in use) per (scheme, host, port)
+IDLE_TIMEOUT = 60  # Seconds an idle keep-alive socket is kept before being closed
+SOCKET_TIMEOUT = 20  # Timeout for connecting and reading from a socket
+
+# Name resolution and connection racing
+DNS_CACHE_TTL = 300  # Seconds a getaddrinfo result is reused; the system resolver doesn't expose record TTLs
+HAPPY_EYEBALLS_DELAY = 0.25  # Seconds before racing the next address while an attempt is still pending (RFC 8305)
+MAX_CONCURRENT_FETCHES = 64  # Requests in flight at once in batch fetching
+
+# Tracing and logging
+VERBOSE = os.environ.get("VARES_VERBOSE", "") not in ("", "0")  # Print progress messages
+MAX_TRACE_EVENTS = 100000  # Oldest trace events are dropped past this
+
+def log(message):
+    # Progress messages, quiet unless VARES_VERBOSE is set. On stderr, which keeps stdout
+    # for the output of the batch modes
+    if VERBOSE:
+        print(message, file=sys.stderr)
+
+class Tracer:
+    def __init__(self, max_events=MAX_TRACE_EVENTS):
+        # Records how long each page-load phase takes, plus cache and socket events
+        self.events = collections.deque(maxlen=max_events)
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        # Time the enclosed block as one phase
+        start = time.perf_counter()
+        try:
+            yield args  # The block may add details to args
+        finally:
+            self.record(name, start, time.perf_counter() - start, **args)
+
+    def record(self, name, start, duration, **args):
+        # Add a phase measured elsewhere; start is a time.perf_counter() value
+        event = {"name": name, "start": start - self.origin, "duration": duration, "thread": threading.get_ident(), "args": args}
+        with self.lock:
+            self.events.append(event)
+
+    def mark(self, name, **args):
+        # Add an instantaneous event, e.g. a cache hit or a reused socket
+        self.record(name, time.perf_counter(), None, **args)
+
+    def phases(self):
+        # Per-phase totals: {name: {"count", "total", "max"}}, durations in seconds
+        summary = {}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            entry = summary.setdefault(event["name"], {"count": 0, "total": 0.0, "max": 0.0})
+            entry["count"] += 1
+            if event["duration"] is not None:
+                entry["total"] += event["duration"]
+                entry["max"] = max(entry["max"], event["duration"])
+        return summary
+
+    def to_json(self):
+        with self.lock:
+            events = list(self.events)
+        return json.dumps({"events": events, "phases": self.phases()}, indent=1)
+
+    def to_chrome_trace(self):
+        # Trace Event Format, loadable in chrome://tracing or Perfetto
+        trace_events = []
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            trace_event = {
+                "name": event["name"],
+                "ts": event["start"] * 1e6,
+                "pid": os.getpid(),
+                "tid": event["thread"],
+                "args": event["args"],
+            }
+            if event["duration"] is None:
+                trace_event["ph"] = "i"
+                trace_event["s"] = "t"
+            else:
+                trace_event["ph"] = "X"
+                trace_event["dur"] = event["duration"] * 1e6
+            trace_events.append(trace_event)
+        return json.dumps({"traceEvents": trace_events, "displayTimeUnit": "ms"})
+
+    def dump(self, path, chrome=True):
+        # Write the trace in Chrome trace format, or as plain JSON with per-phase totals
+        with open(path, "w", encoding="utf8") as f:
+            f.write(self.to_chrome_trace() if chrome else self.to_json())
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+
+tracer = Tracer()  # Global trace of network and rendering phases
+if os.environ.get("VARES_TRACE"):
+    atexit.register(tracer.dump, os.environ["VARES_TRACE"])  # Dump the trace when the program exits
+
+# TLS state shared by every HTTPS connection
+ssl_context = None  # Built on first use, so the CA store is loaded only once
+ssl_context_lock = threading.Lock()
+tls_sessions = {}  # Stores the last TLS session per (host, port) for resumption
+tls_handshakes = {"full": 0, "resumed": 0}  # Handshake counters
+
+def get_ssl_context():
+    # Lazily create the shared SSL context
+    global ssl_context
+    with ssl_context_lock:
+        if ssl_context is None:
+            ssl_context = ssl.create_default_context()
+        return ssl_context
+
+def remember_tls_session(s, host, port):
+    # Keep the socket's TLS session so the next connection to the origin can resume it.
+    # With TLS 1.3 the session ticket only arrives after the handshake, so this is
+    # called again when the socket goes back to the pool
+    session = getattr(s, "session", None)
+    if session is not None:
+        tls_sessions[(host, port)] = session
+
+class Resolver:
+    def __init__(self, ttl=DNS_CACHE_TTL):
+        # Caches getaddrinfo results so reconnecting to a known host skips the lookup
+        self.ttl = ttl
+        self.entries = {}  # (host, port) -> (expiry, [(family, sockaddr)]), in connection order
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, host, port):
+        # Cached addresses of host, or None if they are unknown or expired
+        with self.lock:
+            entry = self.entries.get((host, port))
+            if entry is None or entry[0] <= time.time():
+                return None
+            self.hits += 1
+        tracer.mark("dns_cache_hit", host=host)
+        return list(entry[1])
+
+    def resolve(self, host, port):
+        # Addresses of host, IPv6 and IPv4 interleaved as RFC 8305 suggests, starting
+        # with the family the system prefers. Raises socket.gaierror
+        addresses = self.lookup(host, port)
+        if addresses is not None:
+            return addresses
+        with tracer.span("dns", host=host) as args:
+            infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
+            args["addresses"] = len(infos)
+        by_family = collections.OrderedDict()
+        for family, _, _, _, sockaddr in infos:
+            if (family, sockaddr) not in by_family.setdefault(family, []):
+                by_family[family].append((family, sockaddr))
+        addresses = []
+        families = list(by_family.values())
+        while any(families):
+            for candidates in families:
+                if candidates:
+                    addresses.append(candidates.pop(0))
+        with self.lock:
+            self.misses += 1
+            self.entries[(host, port)] = (time.time() + self.ttl, addresses)
+        return list(addresses)
+
+    def prefer(self, host, port, address):
+        # Move the address that won the last connection race to the front
+        with self.lock:
+            entry = self.entries.get((host, port))
+            if entry is not None and address in entry[1] and entry[1][0] != address:
+                addresses = [address] + [a for a in entry[1] if a != address]
+                self.entries[(host, port)] = (entry[0], addresses)
+
+    def forget(self, host, port):
+        # Drop an entry whose addresses all failed, the host may have moved
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+resolver = Resolver()  # Shared DNS cache
+
+def connect_happy_eyeballs(addresses, timeout=SOCKET_TIMEOUT, delay=HAPPY_EYEBALLS_DELAY):
+    # Race connections to addresses: a new attempt starts every delay seconds, or as soon
+    # as the previous one fails, and the first to connect wins. Returns (socket, address).
+    # Raises socket.timeout, or the OSError of the last failed attempt
+    deadline = time.monotonic() + timeout
+    remaining = list(addresses)
+    pending = {}  # socket -> address of the attempts in flight
+    error = OSError("No addresses to connect to")
+    next_attempt = time.monotonic()
+    try:
+        while remaining or pending:
+            now = time.monotonic()
+            if now >= deadline:
+                raise socket.timeout("timed out")
+            if remaining and (now >= next_attempt or not pending):
+                family, address = remaining.pop(0)
+                s = socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+                s.setblocking(False)
+                code = s.connect_ex(address)
+                if code in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK)):
+                    pending[s] = (family, address)
+                    next_attempt = now + delay
+                else:
+                    s.close()
+                    error = OSError(code, os.strerror(code))
+                continue
+            wait = deadline - now
+            if remaining:
+                wait = min(wait, next_attempt - now)
+            sockets = list(pending)
+            _, writable, failed = select.select([], sockets, sockets, max(0, wait))  # Windows reports refusals as exceptional
+            for s in set(writable) | set(failed):
+                code = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                address = pending.pop(s)
+                if code == 0 and s not in failed:
+                    s.setblocking(True)
+                    return s, address
+                s.close()
+                error = OSError(code, os.strerror(code))
+                next_attempt = now  # Don't wait out the delay after a failure
+        raise error
+    finally:
+        for s in pending:
+            s.close()
+
+def create_connection(scheme, host, port):
+    # Open a new TCP connection, wrapping it with TLS for https
+    try:
+        log(f"Connecting to '{scheme}://{host}' in port {port}...")
+        addresses = resolver.resolve(host, port)
+        with tracer.span("connect", host=host, port=port) as args:
+            s, address = connect_happy_eyeballs(addresses)
+            args["address"] = address[1][0]
+            args["candidates"] = len(addresses)
+        resolver.prefer(host, port, address)
+        s.settimeout(SOCKET_TIMEOUT)  # Set read timeout
+    except socket.timeout:
+        resolver.forget(host, port)
+        raise ConnectionError("Error connecting: Timeout")
+    except socket.gaierror as e:
+        raise ConnectionError(f"Error resolving host {host}: {e}")
+    except Exception as e:
+        resolver.forget(host, port)
+        raise ConnectionError(f"Error connecting: {e}")
+    if scheme == "https":
+        ctx = get_ssl_context()
+        session = tls_sessions.get((host, port))
+        try:
+            log("Initiating SSL handshake...")
+            with tracer.span("tls", host=host) as args:
+                s = ctx.wrap_socket(s, server_hostname=host, session=session)
+                args["resumed"] = s.session_reused
+        except (ssl.SSLError, OSError) as e:
+            s.close()
+            tls_sessions.pop((host, port), None)  # Don't offer a session the server rejected
+            raise ConnectionError(f"SSL Error: {e}")
+        with ssl_context_lock:
+            tls_handshakes["resumed" if s.session_reused else "full"] += 1
+        remember_tls_session(s, host, port)
+    return s
+
+class ConnectionPool:
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST, idle_timeout=IDLE_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.idle = {}  # (scheme, host, port) -> list of (socket, released_at), most recent last
+        self.in_use = {}  # (scheme, host, port) -> number of sockets currently checked out
+        self.owners = {}  # id(socket) -> key, to find the host of a released socket
+        self.condition = threading.Condition()
+
+    def acquire(self, scheme, host, port, fresh=False):
+        # Return (socket, reused); reused sockets have passed a liveness check
+        key = (scheme, host, port)
+        with self.condition:
+            while True:
+                self.prune_idle()  # Every host, or idle sockets to hosts not visited again would stay open
+                idle = self.idle.get(key, [])
+                while idle and not fresh:
+                    s, released_at = idle.pop()
+                    if self.is_alive(s):
+                        self.checkout(key, s)
+                        tracer.mark("socket_reuse", host=host)
+                        return s, True
+                    log(f"Dropping stale connection to '{scheme}://{host}'")
+                    self.owners.pop(id(s), None)
+                    s.close()
+                if fresh and idle:
+                    # A fresh connection was requested, free the slots held by idle sockets
+                    for s, released_at in idle:
+                        self.owners.pop(id(s), None)
+                        s.close()
+                    idle.clear()
+                if self.in_use.get(key, 0) + len(idle) < self.max_per_host:
+                    self.in_use[key] = self.in_use.get(key, 0) + 1  # Reserve a slot while connecting
+                    break
+                if not self.condition.wait(SOCKET_TIMEOUT):
+                    raise ConnectionError(f"Connection pool limit reached for {host}:{port}")
+        try:
+            tracer.mark("socket_new", host=host)
+            s = create_connection(scheme, host, port)
+        except Exception:
+            with self.condition:
+                self.in_use[key] -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.owners[id(s)] = key
+        return s, False
+
+    def checkout(self, key, s):
+        # Mark an idle socket as in use (caller holds the lock)
+        self.in_use[key] = self.in_use.get(key, 0) + 1
+        self.owners[id(s)] = key
+
+    def release(self, s):
+        # Return a socket whose response was fully read so it can be reused
+        with self.condition:
+            key = self.owners.get(id(s))
+            if key is None:
+                s.close()
+                return
+            if isinstance(s, ssl.SSLSocket):
+                remember_tls_session(s, key[1], key[2])
+            self.in_use[key] -= 1
+            self.prune_idle()
+            self.idle.setdefault(key, []).append((s, time.time()))
+            self.condition.notify()
+
+    def discard(self, s):
+        # Close a socket that cannot be reused and free its slot
+        with self.condition:
+            key = self.owners.pop(id(s), None)
+            if key is not None and isinstance(s, ssl.SSLSocket):
+                remember_tls_session(s, key[1], key[2])
+            s.close()
+            if key is not None:
+                self.in_use[key] -= 1
+                self.condition.notify()
+
+    def prune_idle(self, key=None):
+        # Close idle sockets past the idle timeout (caller holds the lock)
+        now = time.time()
+        keys = [key] if key is not None else list(self.idle)
+        for k in keys:
+            kept = []
+            for s, released_at in self.idle.get(k, []):
+                if now - released_at > self.idle_timeout:
+                    self.owners.pop(id(s), None)
+                    s.close()
+                else:
+                    kept.append((s, released_at))
+            if kept:
+                self.idle[k] = kept
+            else:
+                self.idle.pop(k, None)
+
+    def is_alive(self, s):
+        # An idle keep-alive socket should have nothing to read; if it is
+        # readable the server either closed it or sent something unexpected
+        try:
+            if s.fileno() == -1:
+                return False
+            if isinstance(s, ssl.SSLSocket) and s.pending():
+                return False
+            readable, _, _ = select.select([s], [], [], 0)
+            return not readable
+        except (OSError, ValueError):
+            return False
+
+    def close_all(self):
+        # Close every idle socket (sockets in use are closed by their owners)
+        with self.condition:
+            for idle in self.idle.values():
+                for s, released_at in idle:
+                    self.owners.pop(id(s), None)
+                    s.close()
+            self.idle.clear()
+
+connection_pool = ConnectionPool()  # Shared pool of keep-alive sockets
+
+# Pipelining and prefetching
+PIPELINE_STALL_TIMEOUT = 5  # Seconds to wait for each queued response of a pipeline before falling back
+unpipelined_origins = set()  # Origins that mishandled pipelining, their requests go over separate connections
+PREFETCH_LINKS = os.environ.get("VARES_PREFETCH", "") not in ("", "0")  # Prefetch the links of loaded pages
+MAX_PREFETCH_LINKS = 8  # Pages fetched by one prefetch pass
+
+# Disk cache settings
+DISK_CACHE_DIR = os.environ.get("VARES_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".vares_browser", "cache"))
+DISK_CACHE_BYTES = 50 * 1024 * 1024  # Byte budget for cached bodies on disk
+DISK_CACHE_FLUSH_DELAY = 2  # Seconds a changed cache index waits in memory before being written
+DISK_CACHE_ORPHAN_AGE = 10 * 60  # Seconds before a body file missing from the index is deleted, in case its index is still being written
+DEFAULT_SNAPSHOT_FILE = os.path.join(DISK_CACHE_DIR, "default_page.json")  # Layout of Default.html drawn at start-up
+SNAPSHOT_PROBE_TEXT = "Vares Browser 0123456789"  # Measured in each font of a snapshot to tell if the fonts changed
+MEMORY_CACHE_BYTES = 32 * 1024 * 1024  # Byte budget for responses cached in memory
+CACHE_ENTRY_OVERHEAD = 512  # Approximate bytes of a memory cache entry besides its body
+CACHEABLE_STATUSES = (200, 301, 404)
+
+class CachedResponse:
+    def __init__(self, content, expiry, etag=None, last_modified=None, status=200, location=None, encoding=None):
+        self.stored = content  # Body bytes as kept: decompressed, or as received when encoding is "gzip"
+        self.encoding = encoding
+        self.expiry = expiry  # Absolute expiry time, None if it never expires
+        self.etag = etag  # ETag validator, sent back as If-None-Match
+        self.last_modified = last_modified  # Last-Modified validator, sent back as If-Modified-Since
+        self.status = status
+        self.location = location  # Absolute target of a remembered redirect, None for a body
+
+    def body(self):
+        # Decompressed body bytes
+        if self.encoding != "gzip":
+            return self.stored
+        with tracer.span("decompress", codings=self.encoding, cached=True):
+            return gzip.decompress(self.stored)
+
+    def is_fresh(self):
+        return self.expiry is None or time.time() < self.expiry
+
+    def has_validators(self):
+        return bool(self.etag or self.last_modified)
+
+def cache_policy(response_headers):
+    # Return (cacheable, expiry) from the response's Cache-Control header
+    cache_control = response_headers.get("cache-control", "").lower()
+    if "no-store" in cache_control:
+        return False, None
+    max_age = None
+    for directive in cache_control.split(","):
+        directive = directive.strip()
+        if directive.startswith("max-age="):
+            try:
+                max_age = int(directive.split("=")[1])
+                break
+            except (IndexError, ValueError):
+                continue
+    if "no-cache" in cache_control:
+        max_age = 0  # Must be revalidated before every use
+    if max_age is not None:
+        return True, time.time() + max_age
+    if "etag" in response_headers or "last-modified" in response_headers:
+        return True, time.time()  # No explicit lifetime, revalidate on every use
+    return True, None
+
+class DiskCache:
+    def __init__(self, directory=DISK_CACHE_DIR, max_bytes=DISK_CACHE_BYTES):
+        self.directory = directory  # None keeps nothing on disk
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # key -> metadata, least recently used first
+        self.total_bytes = 0
+        self.loaded = False  # Index is read on first use
+        self.lock = threading.Lock()
+        # The index is kept in memory and written DISK_CACHE_FLUSH_DELAY after it changes,
+        # right away on eviction, and when the program exits
+        self.dirty = False
+        self.flush_timer = None
+        # Other processes (another window, --fetch) may share the directory: their entries
+        # are merged in before the index is written, except the ones removed here
+        self.removed = set()
+        if directory is not None:
+            atexit.register(self.flush)
+
+    def body_path(self, key):
+        name = hashlib.sha1(repr(key).encode("utf8")).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    def read_index(self):
+        # The entries of the index on disk, least recently used first, as (key, metadata);
+        # entries whose body file is gone are dropped
+        try:
+            with open(self.index_path(), "r", encoding="utf8") as f:
+                records = json.load(f)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable cache index: {e}", file=sys.stderr)
+            return []
+        entries = []
+        for record in records:
+            try:
+                scheme, host, port, path, meta = record
+                key = (scheme, host, port, path)
+                meta["size"] = os.path.getsize(self.body_path(key))
+            except (ValueError, TypeError, OSError):
+                continue
+            entries.append((key, meta))
+        return entries
+
+    def load(self):
+        # Read the index from disk, then delete body files it doesn't list, left behind by
+        # a process that stopped before writing its index or lost an index write race
+        self.loaded = True
+        for key, meta in self.read_index():
+            self.entries[key] = meta
+            self.total_bytes += meta["size"]
+        listed = {os.path.basename(self.body_path(key)) for key in self.entries}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        now = time.time()
+        for name in names:
+            if len(name) != 40 or name in listed:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > DISK_CACHE_ORPHAN_AGE:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def merge_index(self):
+        # Take in the entries other processes added to the index on disk since it was
+        # read, as older than this process's own (caller holds the lock)
+        merged = collections.OrderedDict()
+        for key, meta in self.read_index():
+            if key not in self.entries and key not in self.removed:
+                merged[key] = meta
+                self.total_bytes += meta["size"]
+        self.removed.clear()
+        if merged:
+            merged.update(self.entries)
+            self.entries = merged
+
+    def mark_dirty(self):
+        # Schedule writing the index (caller holds the lock)
+        self.dirty = True
+        if self.flush_timer is None:
+            self.flush_timer = threading.Timer(DISK_CACHE_FLUSH_DELAY, self.flush)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def flush(self):
+        # Write the index now if it changed since it was last written
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if self.dirty:
+                self.save_index()
+
+    def save_index(self):
+        # Write the index atomically, in LRU order (caller holds the lock)
+        self.dirty = False
+        self.merge_index()
+        while self.total_bytes > self.max_bytes and self.entries:
+            self.remove(next(iter(self.entries)))
+        self.removed.clear()
+        records = [[key[0], key[1], key[2], key[3], meta] for key, meta in self.entries.items()]
+        temp_path = self.index_path() + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf8") as f:
+                json.dump(records, f)
+            os.replace(temp_path, self.index_path())
+        except OSError as e:
+            print(f"Error writing cache index: {e}", file=sys.stderr)
+
+    def get(self, key):
+        if self.directory is None:
+            return None
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            meta = self.entries.get(key)
+            if meta is None:
+                return None
+            try:
+                with open(self.body_path(key), "rb") as f:
+                    content = f.read()
+            except OSError:
+                self.remove(key)
+                self.mark_dirty()
+                return None
+            self.entries.move_to_end(key)  # Mark as most recently used
+            self.mark_dirty()
+            return CachedResponse(content, meta["expiry"], meta.get("etag"), meta.get("last_modified"), meta.get("status", 200), meta.get("location"), meta.get("encoding"))
+
+    def put(self, key, cached):
+        if self.directory is None or len(cached.stored) > self.max_bytes:
+            return
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(self.body_path(key), "wb") as f:
+                    f.write(cached.stored)
+            except OSError as e:
+                print(f"Error writing cache entry: {e}", file=sys.stderr)
+                return
+            if key in self.entries:
+                self.total_bytes -= self.entries[key]["size"]
+            self.entries[key] = {
+                "size": len(cached.stored),
+                "expiry": cached.expiry,
+                "etag": cached.etag,
+                "last_modified": cached.last_modified,
+                "status": cached.status,
+                "location": cached.location,
+                "encoding": cached.encoding,
+            }
+            self.entries.move_to_end(key)
+            self.total_bytes += len(cached.stored)
+            # Evict least recently used entries until the budget is respected
+            if self.total_bytes > self.max_bytes:
+                while self.total_bytes > self.max_bytes and self.entries:
+                    self.remove(next(iter(self.entries)))
+                self.save_index()  # Right away, so the index doesn't list deleted bodies
+            else:
+                self.mark_dirty()
+
+    def update_expiry(self, key, expiry):
+        # Refresh the lifetime of an entry revalidated with a 304
+        if self.directory is None:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.entries[key]["expiry"] = expiry
+                self.entries.move_to_end(key)
+                self.mark_dirty()
+
+    def delete(self, key):
+        if self.directory is None:
+            return
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if key in self.entries:
+                self.remove(key)
+                self.mark_dirty()
+
+    def remove(self, key):
+        # Drop an entry and its body file (caller holds the lock)
+        meta = self.entries.pop(key)
+        self.removed.add(key)
+        self.total_bytes -= meta["size"]
+        try:
+            os.remove(self.body_path(key))
+        except OSError:
+            pass
+
+disk_cache = DiskCache()  # Persistent cache shared across sessions
+
+class MemoryCache:
+    def __init__(self, max_bytes=MEMORY_CACHE_BYTES):
+        # Responses kept in memory in front of the disk cache, within a byte budget.
+        # Entries are evicted least recently used first, expired or not
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # key -> CachedResponse, least recently used first
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                self.entries.move_to_end(key)  # Mark as most recently used
+            return cached
+
+    def put(self, key, cached):
+        size = len(cached.stored) + CACHE_ENTRY_OVERHEAD
+        with self.lock:
+            self.remove(key)
+            if size > self.max_bytes:
+                return
+            self.entries[key] = cached
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def delete(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def remove(self, key):
+        # Drop an entry if present (caller holds the lock)
+        cached = self.entries.pop(key, None)
+        if cached is not None:
+            self.total_bytes -= len(cached.stored) + CACHE_ENTRY_OVERHEAD
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+cached_responses = MemoryCache()  # Responses cached in memory, in front of the disk cache
 
-# Redirect control variables
-redirects_number = 0  # Tracks number of redirects
-redirects_limit = 10  # Maximum allowed redirects to prevent loops
+class Flight:
+    def __init__(self):
+        # A network fetch shared by concurrent requests for the same cache key
+        self.done = threading.Event()
+        self.text = None  # Page text the fetch returned
+        self.error = None  # Exception the fetch raised
+
+class RequestCoalescer:
+    def __init__(self):
+        # Fetches in progress by cache key, so a page requested again while it is
+        # still being fetched (e.g. by a prefetch) goes to the network only once
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def join(self, key):
+        # Return (flight, leader); the leader fetches, the others wait for its result
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self.flights[key] = Flight()
+            return flight, True
+
+    def finish(self, key, flight, text=None, error=None):
+        with self.lock:
+            del self.flights[key]
+        flight.text = text
+        flight.error = error
+        flight.done.set()
+
+request_coalescer = RequestCoalescer()
+
+# Response body limits
+MAX_BODY_SIZE = 100 * 1024 * 1024  # Largest decoded body accepted, protects against huge or bomb payloads
+BODY_CHUNK_SIZE = 64 * 1024  # Bytes read from the socket (and produced by decompression) per step
+FILE_CHUNK_SIZE = 256 * 1024  # Bytes of a local file decoded per chunk when it is streamed
+
+def file_chunks(f):
+    # Byte chunks of an open binary file. Regular files are sliced from a memory map,
+    # so a huge file is never read into one buffer; empty or special files are read
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+        yield from iter(lambda: f.read(FILE_CHUNK_SIZE), b"")
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for start in range(0, size, FILE_CHUNK_SIZE):
+            yield mapped[start:start + FILE_CHUNK_SIZE]
+
+class ResponseBody:
+    def __init__(self, response, response_headers, status, max_size=None):
+        self.response = response  # Buffered file over the socket
+        self.headers = response_headers
+        self.max_size = max_size if max_size is not None else MAX_BODY_SIZE
+        self.has_body = not (status in (204, 304) or 100 <= status < 200)
+        transfer_codings = [c.strip().lower() for c in response_headers.get("transfer-encoding", "").split(",") if c.strip()]
+        self.chunked = bool(transfer_codings) and transfer_codings[-1] == "chunked"
+        if self.chunked:
+            transfer_codings.pop()
+        content_codings = [c.strip().lower() for c in response_headers.get("content-encoding", "").split(",") if c.strip()]
+        # Codings are undone in reverse order: transfer codings first, then content codings
+        self.codings = [c for c in transfer_codings[::-1] + content_codings[::-1] if c != "identity"]
+        for coding in self.codings:
+            if coding not in ("gzip", "x-gzip", "deflate"):
+                raise ValueError(f"Unsupported encoding: '{coding}'")
+        self.complete = False  # True once the body was read up to its framed end
+        self.decompress_time = 0.0  # Seconds spent in zlib, traced as its own phase
+        # A gzip-only body is also kept as received, so caches can store it compressed
+        self.encoded = bytearray() if self.codings in (["gzip"], ["x-gzip"]) else None
+
+    def raw_chunks(self):
+        # Yield the body bytes as they arrive, still encoded
+        if not self.has_body:
+            self.complete = True
+            return
+        received = 0
+        if self.chunked:
+            log("Chunked encoding detected")
+            while True:
+                chunk_size = self.response.readline().decode("utf8").strip()
+                if not chunk_size:
+                    return  # Connection ended before the last chunk
+                try:
+                    chunk_size = int(chunk_size.split(";", 1)[0], 16)
+                except ValueError:
+                    raise ValueError(f"Chunk size invalid: '{chunk_size}'")
+                if chunk_size == 0:
+                    # Skip optional trailers up to the blank line
+                    while self.response.readline().strip():
+                        pass
+                    self.complete = True
+                    return
+                while chunk_size > 0:
+                    data = self.response.read(min(chunk_size, BODY_CHUNK_SIZE))
+                    if not data:
+                        return
+                    received = self.check_size(received, data)
+                    chunk_size -= len(data)
+                    yield data
+                self.response.readline()
+        elif "content-length" in self.headers:
+            try:
+                remaining = int(self.headers["content-length"])
+            except ValueError:
+                raise ValueError(f"Content-Length invalid: '{self.headers['content-length']}'")
+            while remaining > 0:
+                data = self.response.read1(min(remaining, BODY_CHUNK_SIZE))
+                if not data:
+                    return  # Body shorter than announced
+                received = self.check_size(received, data)
+                remaining -= len(data)
+                yield data
+            self.complete = True
+        else:
+            # Body is delimited by the server closing the connection, the socket can't be reused
+            while True:
+                data = self.response.read1(BODY_CHUNK_SIZE)
+                if not data:
+                    return
+                received = self.check_size(received, data)
+                yield data
+
+    def check_size(self, received, data):
+        received += len(data)
+        if received > self.max_size:
+            raise ValueError(f"Response body exceeds maximum size of {self.max_size} bytes")
+        return received
+
+    def decompress(self, chunks, coding):
+        # Incrementally undo one content/transfer coding
+        log(f"{coding.capitalize()} compression detected")
+        wbits = 16 + zlib.MAX_WBITS if coding in ("gzip", "x-gzip") else zlib.MAX_WBITS
+        decompressor = zlib.decompressobj(wbits)
+        first = True
+        for data in chunks:
+            while data:
+                try:
+                    start = time.perf_counter()
+                    out = decompressor.decompress(data, BODY_CHUNK_SIZE)
+                    self.decompress_time += time.perf_counter() - start
+                except zlib.error as e:
+                    if first and coding == "deflate":
+                        # Some servers send raw deflate data without the zlib header
+                        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                        first = False
+                        continue
+                    raise ValueError(f"Error decompressing {coding} content: {e}")
+                first = False
+                if out:
+                    yield out
+                if decompressor.unconsumed_tail:
+                    data = decompressor.unconsumed_tail
+                elif decompressor.eof and decompressor.unused_data:
+                    # Concatenated gzip members
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits)
+                else:
+                    data = b""
+        out = decompressor.flush()
+        if out:
+            yield out
+        if not decompressor.eof:
+            self.encoded = None  # Truncated stream, only what was decoded can be cached
+
+    def __iter__(self):
+        # Yield decoded body chunks as they are read
+        return self.decoded(self.raw_chunks())
+
+    def decoded(self, chunks):
+        # Undo the response's codings over any iterable of raw chunks
+        if self.encoded is not None:
+            chunks = self.keep_encoded(chunks)
+        for coding in self.codings:
+            chunks = self.decompress(chunks, coding)
+        decoded = 0
+        for data in chunks:
+            decoded = self.check_size(decoded, data)
+            yield data
+
+    def keep_encoded(self, chunks):
+        for data in chunks:
+            self.encoded += data
+            yield data
+
+    def read(self):
+        # Accumulate the whole decoded body into a single buffer
+        content = bytearray()
+        for data in self:
+            content += data
+        return content
+
+def parse_header_line(line, response_headers):
+    # Add one "Name: value" line to the headers dict, names are case-insensitive
+    try:
+        header, value = line.split(":", 1)
+        response_headers[header.casefold()] = value.strip()
+    except ValueError:
+        log(f"Invalid header ignored: '{line}'")
 
 class URL:
     def __init__(self, url):
@@ -102,9 +1046,21 @@ class URL:
                 else:
                     self.data = data
 
-    def request(self, user_agent="Vares Browser"):
-        # Access global redirect variables
-        global redirects_limit, redirects_number
+    def __str__(self):
+        # Printable form for messages; about:blank URLs have no scheme
+        if self.path == "about:blank":
+            text = "about:blank"
+        elif self.scheme == "data":
+            text = f"data:{self.mime_type},..."
+        else:
+            text = f"{self.scheme}://{self.host}{self.path}"
+        return "view-source:" + text if self.view_source else text
+
+    def request(self, user_agent="Vares Browser", on_chunk=None, redirects=0):
+        # on_chunk, if given, receives the decoded text of a network body or local file as
+        # it arrives; a streamed file is then not returned, and bodies from the cache or a
+        # data URL are only returned.
+        # redirects counts the redirects already followed to reach this URL
         # Handle about:blank URL
         if self.path == "about:blank":
             return "<>"
@@ -114,284 +1070,1262 @@ class URL:
             if os.name == "nt" and file_path.startswith("/"):
                 file_path = file_path[1:]  # Fix path for Windows
             try:
+                if on_chunk is not None:
+                    self.stream_file(file_path, on_chunk)
+                    return ""
                 with open(file_path, "r", encoding="utf8") as f:
                     return f.read()
             except FileNotFoundError:
                 raise ValueError(f"File not found: {file_path}")
-            except Exception as e:
+            except (OSError, UnicodeDecodeError) as e:
+                # Only read errors; LoadCancelled from on_chunk has to reach LoadTask.run
                 raise ValueError(f"Error while reading file {file_path}: {e}")
         # Return inline data for data scheme
         if self.scheme == "data":
             return self.data
-        # Check cache for existing response
+        # Check memory cache, then disk cache, for existing response
+        cache_key, cached = self.lookup_cache()
+        if cached and cached.is_fresh():
+            if cached.location:
+                return self.follow_redirect(cached.location, redirects).request(user_agent, on_chunk, redirects + 1)
+            return cached.body().decode("utf8")
+        if redirects:
+            return self.fetch(cache_key, cached, user_agent, on_chunk, redirects)
+        # Only one request per cache key goes to the network; concurrent ones for the
+        # same key wait for it and share its text. Redirects aren't coalesced, so a
+        # redirect loop can't wait on itself
+        flight, leader = request_coalescer.join(cache_key)
+        if not leader:
+            tracer.mark("request_coalesced", url=f"{self.scheme}://{self.host}{self.path}")
+            flight.done.wait()
+            if flight.error is None:
+                return flight.text
+            if isinstance(flight.error, LoadCancelled):
+                return self.request(user_agent, on_chunk, redirects)  # Only the other load was cancelled
+            raise flight.error
+        try:
+            text = self.fetch(cache_key, cached, user_agent, on_chunk, redirects)
+        except BaseException as e:
+            request_coalescer.finish(cache_key, flight, error=e)
+            raise
+        request_coalescer.finish(cache_key, flight, text)
+        return text
+
+    def fetch(self, cache_key, cached, user_agent, on_chunk=None, redirects=0):
+        # Get this URL from the network, revalidating cached if it's given, and return its text
+        request = self.build_request(user_agent, cached)
+        # Send the request on a pooled socket. GET is idempotent, so if a reused
+        # keep-alive socket turns out to be dead it is retried once on a fresh one
+        retried = False
+        while True:
+            s, reused = connection_pool.acquire(self.scheme, self.host, self.port, fresh=retried)
+            try:
+                with tracer.span("request_write", host=self.host, reused=reused):
+                    s.sendall(request)  # Send request to server
+                with tracer.span("ttfb", url=f"{self.scheme}://{self.host}{self.path}"):
+                    response = s.makefile("rb", newline=b"\r\n")
+                    statusline = response.readline().decode("utf8").strip()
+            except (ConnectionError, socket.timeout, OSError) as e:
+                connection_pool.discard(s)
+                if reused and not retried:
+                    log("Kept-alive connection dropped, retrying on a new connection...")
+                    retried = True
+                    continue
+                raise ConnectionError(f"Error sending request: {e}")
+            if not statusline:
+                connection_pool.discard(s)
+                if reused and not retried:
+                    log("Kept-alive connection dropped, retrying on a new connection...")
+                    retried = True
+                    continue
+                raise ValueError("No server answer")
+            break
+        try:
+            status, response_headers, content, reusable, encoded = self.read_response(response, statusline, on_chunk)
+        except BaseException:
+            connection_pool.discard(s)  # e.g. the load was cancelled from on_chunk
+            raise
+        # Return the socket to the pool, or close it if the server requests
+        if reusable:
+            connection_pool.release(s)
+        else:
+            connection_pool.discard(s)
+        return self.finish_response(cache_key, cached, status, response_headers, content, user_agent, on_chunk, redirects, encoded)
+
+    def stream_file(self, file_path, on_chunk):
+        # Decode a local file incrementally, so a character split between two chunks is
+        # completed by the next one, and hand it to on_chunk piece by piece
+        decoder = codecs.getincrementaldecoder("utf8")()
+        with tracer.span("file", path=file_path) as args, open(file_path, "rb") as f:
+            size = 0
+            for data in file_chunks(f):
+                size += len(data)
+                text = decoder.decode(data)
+                if text:
+                    on_chunk(text)
+            text = decoder.decode(b"", final=True)
+            if text:
+                on_chunk(text)
+            args["bytes"] = size
+
+    def read_response(self, response, statusline, on_chunk=None):
+        # Parse the rest of a response whose status line was read from the socket file.
+        # Returns (status, headers, decoded body, reusable, encoded), where reusable means
+        # the socket is positioned at the next response and may be kept alive, and encoded
+        # is the body as received when it was only gzip-compressed, else None
+        try:
+            version, status, explanation = statusline.split(" ", 2)
+            status = int(status)
+        except ValueError:
+            raise ValueError(f"Status line invalid: {statusline}")
+        # Parse response headers
+        response_headers = {}
+        try:
+            while True:
+                line = response.readline().decode("utf8").strip()
+                if line == "":
+                    break
+                parse_header_line(line, response_headers)
+        except OSError as e:
+            raise ConnectionError(f"Error reading response: {e}")
+        # Read response body, so the socket is free for the next request
+        body_start = time.perf_counter()
+        try:
+            body = ResponseBody(response, response_headers, status)
+            if on_chunk is not None and status != 304 and status not in REDIRECT_STATUSES:
+                content = bytearray()
+                decoder = codecs.getincrementaldecoder("utf8")()
+                for data in body:
+                    content += data
+                    text = decoder.decode(data)
+                    if text:
+                        on_chunk(text)
+                text = decoder.decode(b"", final=True)
+                if text:
+                    on_chunk(text)
+            else:
+                content = body.read()
+        except OSError as e:
+            raise ConnectionError(f"Error reading response: {e}")
+        # Body reading includes the decompression interleaved with it, also traced on its own
+        tracer.record("body_read", body_start, time.perf_counter() - body_start, url=f"{self.scheme}://{self.host}{self.path}", bytes=len(content), status=status)
+        if body.codings:
+            tracer.record("decompress", body_start, body.decompress_time, codings=",".join(body.codings))
+        reusable = body.complete and response_headers.get("connection", "").lower() != "close"
+        return status, response_headers, content, reusable, body.encoded
+
+    def finish_response(self, cache_key, cached, status, response_headers, content, user_agent, on_chunk=None, redirects=0, encoded=None):
+        # Apply a response to the cache and return the page text, following redirects
+        # Reuse the stored body when the server confirms it has not changed
+        if status == 304 and cached:
+            return self.revalidated(cache_key, cached, response_headers).decode("utf8")
+        # Handle redirects
+        if status in REDIRECT_STATUSES:
+            new_url = self.redirect_target(response_headers)
+            self.store_redirect(cache_key, status, response_headers, new_url)
+            return self.follow_redirect(new_url, redirects).request(user_agent, on_chunk, redirects + 1)
+        # Cache response if applicable
+        self.store_response(cache_key, cached, status, response_headers, content, encoded)
+        return content.decode("utf8")
+
+    def request_many(self, paths, user_agent="Vares Browser", pipeline=True):
+        # Fetch several paths on this URL's origin, returning their texts in order; a
+        # path that failed gets its exception instead. With pipeline, the requests
+        # that miss the cache are written back to back on one keep-alive socket,
+        # otherwise they are spread over pooled connections. Whatever the pipeline
+        # couldn't deliver is fetched again on its own
+        urls = [URL(self.origin() + path) for path in paths]
+        results = [None] * len(urls)
+        pending = []  # (index, cache_key, cached) of the paths that need the network
+        for i, url in enumerate(urls):
+            cache_key, cached = url.lookup_cache()
+            if cached and cached.is_fresh() and not cached.location:
+                results[i] = cached.body().decode("utf8")
+            else:
+                pending.append((i, cache_key, cached))
+        if pipeline and len(pending) > 1 and self.origin() not in unpipelined_origins:
+            pending = self.pipeline(urls, pending, results, user_agent)
+        # Spread the rest over as many connections as the pool allows for this origin
+        work = queue.Queue()
+        for i, cache_key, cached in pending:
+            work.put(i)
+        def worker():
+            while True:
+                try:
+                    i = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[i] = urls[i].request(user_agent)
+                except Exception as e:
+                    results[i] = e
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(min(len(pending), connection_pool.max_per_host) - 1)]
+        for thread in workers:
+            thread.start()
+        worker()  # The calling thread works too
+        for thread in workers:
+            thread.join()
+        return results
+
+    def pipeline(self, urls, pending, results, user_agent):
+        # Send every pending request on one socket and read the responses in order.
+        # Returns the entries of pending that didn't get an answer. A server that
+        # drops or stalls pipelined requests without announcing Connection: close
+        # is remembered, and its origin isn't pipelined again
+        origin = self.origin()
+        try:
+            s, reused = connection_pool.acquire(self.scheme, self.host, self.port)
+        except ConnectionError:
+            return pending
+        requests = b"".join(urls[i].build_request(user_agent, cached) for i, cache_key, cached in pending)
+        delivered = 0
+        reusable = True
+        misbehaved = False
+        with tracer.span("pipeline", host=self.host, requests=len(pending)) as args:
+            try:
+                s.sendall(requests)
+                response = s.makefile("rb", newline=b"\r\n")
+                for i, cache_key, cached in pending:
+                    if delivered == 1:
+                        s.settimeout(PIPELINE_STALL_TIMEOUT)  # Don't wait long on a server ignoring the queued requests
+                    statusline = response.readline().decode("utf8").strip()
+                    if not statusline:
+                        misbehaved = delivered > 0 or not reused  # A reused socket may simply have expired
+                        break
+                    status, response_headers, content, reusable, encoded = urls[i].read_response(response, statusline)
+                    delivered += 1
+                    try:
+                        results[i] = urls[i].finish_response(cache_key, cached, status, response_headers, content, user_agent, encoded=encoded)
+                    except Exception as e:
+                        results[i] = e  # e.g. a redirect that failed
+                    if not statusline.startswith("HTTP/1.1"):
+                        misbehaved = delivered < len(pending)  # HTTP/1.0 servers don't pipeline
+                        break
+                    if not reusable:
+                        break  # The server closes after this response, the rest are fetched again
+            except (OSError, ValueError) as e:
+                log(f"Pipelining to {origin} failed after {delivered} responses: {e}")
+                reusable = False
+                misbehaved = delivered > 0 or not reused
+            args["delivered"] = delivered
+        if reusable and delivered == len(pending):
+            s.settimeout(SOCKET_TIMEOUT)
+            connection_pool.release(s)
+        else:
+            connection_pool.discard(s)
+        if misbehaved:
+            log(f"Not pipelining to {origin} anymore")
+            unpipelined_origins.add(origin)
+        return pending[delivered:]
+
+    def lookup_cache(self):
+        # Return (cache_key, cached), where cached is fresh, stale with validators, or None
         cache_key = (self.scheme, self.host, self.port, self.path)
         cached = cached_responses.get(cache_key)
+        if cached is None:
+            cached = disk_cache.get(cache_key)
+            if cached is not None:
+                cached_responses.put(cache_key, cached)
         if cached:
-            content, expiry = cached
-            if expiry is None or time.time() < expiry:
-                print(f"Using cached response for {self.scheme}://{self.host}{self.path}")
-                return content.decode("utf8")
-            else:
-                print(f"Cache expired for {self.scheme}://{self.host}{self.path}")
-                del cached_responses[cache_key]
-        # Reuse or create new socket connection
-        socket_key = (self.host, self.port)
-        s = open_sockets.get(socket_key)
-        if s is None:
-            s = socket.socket(
-                family=socket.AF_INET,
-                type=socket.SOCK_STREAM,
-                proto=socket.IPPROTO_TCP,
-            )
-            s.settimeout(20)  # Set connection timeout
-            try:
-                print(f"Connecting to '{self.scheme + '://' + self.host + self.path}' in port {self.port}...")
-                s.connect((self.host, self.port))
-            except socket.timeout:
-                s.close()
-                raise ConnectionError("Error connecting: Timeout")
-            except socket.gaierror as e:
-                raise ConnectionError(f"Error resolving host {self.host}: {e}")
-            except Exception as e:
-                raise ConnectionError(f"Error connecting: {e}")
-            if self.scheme == "https":
-                ctx = ssl.create_default_context()
-                try:
-                    print("Initiating SSL handshake...")
-                    s = ctx.wrap_socket(s, server_hostname=self.host)
-                except ssl.SSLError as e:
-                    s.close()
-                    raise ConnectionError(f"SSL Error: {e}")
-            open_sockets[socket_key] = s
+            if cached.is_fresh():
+                log(f"Using cached response for {self.scheme}://{self.host}{self.path}")
+                tracer.mark("cache_hit", url=f"{self.scheme}://{self.host}{self.path}")
+                return cache_key, cached
+            elif not cached.has_validators():
+                log(f"Cache expired for {self.scheme}://{self.host}{self.path}")
+                cached_responses.delete(cache_key)
+                disk_cache.delete(cache_key)
+                cached = None
+        tracer.mark("cache_miss" if cached is None else "cache_stale", url=f"{self.scheme}://{self.host}{self.path}")
+        return cache_key, cached
+
+    def build_request(self, user_agent, cached=None):
         # Build HTTP request with headers
         headers = [
             f"Host: {self.host}\r\n",
             "Connection: keep-alive\r\n",
             f"User-Agent: {user_agent}\r\n",
-            "Accept-Encoding: gzip\r\n",
-            "\r\n"
+            "Accept-Encoding: gzip, deflate\r\n",
         ]
+        if cached:
+            # Stale entry with validators: ask the server whether it changed
+            log(f"Revalidating cached response for {self.scheme}://{self.host}{self.path}")
+            if cached.etag:
+                headers.append(f"If-None-Match: {cached.etag}\r\n")
+            if cached.last_modified:
+                headers.append(f"If-Modified-Since: {cached.last_modified}\r\n")
+        headers.append("\r\n")
         request = f"GET {self.path} HTTP/1.1\r\n"
         for header in headers:
             request += header
-        s.send(request.encode("utf8"))  # Send request to server
-        # Read response
-        response = s.makefile("rb", newline=b"\r\n")
-        statusline = response.readline().decode("utf8").strip()
-        if not statusline:
-            s.close()
-            open_sockets.pop(socket_key, None)
-            raise ValueError("No server answer")
+        return request.encode("utf8")
+
+    def revalidated(self, cache_key, cached, response_headers):
+        # Refresh a cached entry after a 304 and return its body
+        log(f"Cached response for {self.scheme}://{self.host}{self.path} is still valid")
+        tracer.mark("cache_revalidated", url=f"{self.scheme}://{self.host}{self.path}")
+        cacheable, expiry = cache_policy(response_headers)
+        cached.expiry = expiry if cacheable else time.time()
+        disk_cache.update_expiry(cache_key, cached.expiry)
+        return cached.body()
+
+    def redirect_target(self, response_headers):
+        # Resolve the Location header of a redirect against this URL
+        new_url = response_headers.get("location", "").strip()
+        if not new_url:
+            raise ValueError(f"Redirect response missing 'Location' header")
+        return self.resolve(new_url)
+
+    def origin(self):
+        # scheme://host[:port], with the port only when it isn't the default
+        origin = self.scheme + "://" + self.host
+        if self.port != (80 if self.scheme == "http" else 443):
+            origin += f":{self.port}"  # Keep a non default port
+        return origin
+
+    def resolve(self, href):
+        # Absolute form of a link or Location found on this page, without its fragment
+        href = href.split("#", 1)[0]
+        if "://" in href:
+            return href
+        if href[:2] == "//":
+            return self.scheme + ":" + href  # Scheme relative
+        if href[:1] == "/":
+            return self.origin() + href
+        directory = self.path.split("?", 1)[0].rsplit("/", 1)[0]
+        return self.origin() + directory + "/" + href
+
+    def follow_redirect(self, new_url, redirects):
+        # URL to request next, once the redirect limit has been checked
+        if redirects >= MAX_REDIRECTS:
+            raise ValueError("Redirects limit reached")
+        log(f"Redirecting to: '{new_url}'...")
+        return URL(new_url)
+
+    def store_redirect(self, cache_key, status, response_headers, new_url):
+        # Remember where a redirect points, so later loads go straight to the target.
+        # Permanent redirects are kept unless marked no-store; temporary ones only
+        # when Cache-Control gives them a lifetime. Validators are ignored, a stale
+        # redirect is simply followed again
+        cacheable, expiry = cache_policy({"cache-control": response_headers.get("cache-control", "")})
+        if not cacheable:
+            return
+        if status not in PERMANENT_REDIRECT_STATUSES and (expiry is None or expiry <= time.time()):
+            return
+        cached = CachedResponse(b"", expiry, status=status, location=new_url)
+        cached_responses.put(cache_key, cached)
+        disk_cache.put(cache_key, cached)
+        log(f"Remembering redirect from {self.scheme}://{self.host}{self.path} to {new_url}")
+
+    def store_response(self, cache_key, cached, status, response_headers, content, encoded=None):
+        # Cache response if applicable. A body that arrived gzip-compressed (encoded) is
+        # stored that way and decompressed when it is used
+        if status in CACHEABLE_STATUSES:
+            cacheable, expiry = cache_policy(response_headers)
+            if cacheable:
+                if encoded is not None:
+                    cached = CachedResponse(bytes(encoded), expiry, response_headers.get("etag"), response_headers.get("last-modified"), status, encoding="gzip")
+                else:
+                    cached = CachedResponse(content, expiry, response_headers.get("etag"), response_headers.get("last-modified"), status)
+                cached_responses.put(cache_key, cached)
+                if expiry is not None:
+                    disk_cache.put(cache_key, cached)  # Responses without a lifetime stay in memory only
+                log(f"Caching response for {self.scheme}://{self.host}{self.path}")
+            elif cached:
+                cached_responses.delete(cache_key)  # Drop the stale entry that was revalidated
+                disk_cache.delete(cache_key)
+
+class FetchResult:
+    def __init__(self, url):
+        # Outcome of one URL in a batch fetch
+        self.url = url
+        self.status = None
+        self.bytes = 0  # Decoded body size
+        self.elapsed = 0.0  # Seconds, including redirects
+        self.from_cache = False
+        self.error = None
+        self.content = None  # Decoded body bytes, kept only when asked for
+
+class AsyncFetcher:
+    def __init__(self, per_host=MAX_CONNECTIONS_PER_HOST, max_concurrency=MAX_CONCURRENT_FETCHES, user_agent="Vares Browser", keep_content=False):
+        # asyncio version of URL.request, sharing its cache, for fetching many URLs concurrently
+        self.per_host = per_host
+        self.user_agent = user_agent
+        self.keep_content = keep_content
+        self.max_concurrency = max_concurrency
+        self.concurrency = None  # Semaphore of max_concurrency slots, made in the running loop
+        self.host_limits = {}  # (scheme, host, port) -> semaphore of per_host slots
+        self.idle = {}  # (scheme, host, port) -> list of idle (reader, writer)
+        self.flights = {}  # cache key -> future of a request in progress, shared by duplicates
+
+    async def fetch_all(self, urls):
+        # Before Python 3.10 a semaphore binds to the loop current when it's created, and
+        # later ones to the first loop that waits on it, so they're made for each run here
+        # rather than in __init__, which runs before asyncio.run
+        self.concurrency = asyncio.Semaphore(self.max_concurrency)
+        self.host_limits = {}
         try:
-            version, status, explanation = statusline.split(" ", 2)
-            status = int(status)
-        except ValueError:
-            s.close()
-            open_sockets.pop(socket_key, None)
-            raise ValueError(f"Status line invalid: {statusline}")
-        # Parse response headers
-        response_headers = {}
-        while True:
-            line = response.readline().decode("utf8").strip()
-            if line == "":
+            return await asyncio.gather(*(self.fetch(url) for url in urls))
+        finally:
+            self.close()
+
+    async def fetch(self, url_string):
+        result = FetchResult(url_string)
+        start = time.perf_counter()
+        try:
+            async with self.concurrency:
+                status, content = await self.request(URL(url_string), result)
+            result.status = status
+            result.bytes = len(content)
+            if self.keep_content:
+                result.content = content
+        except Exception as e:
+            result.error = str(e) or type(e).__name__
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    async def request(self, url, result, redirects=0):
+        # Return (status, decoded body bytes) following redirects and using the cache
+        if url.path == "about:blank" or url.scheme not in ("http", "https"):
+            return 200, url.request(self.user_agent).encode("utf8")  # Local content, no network involved
+        cache_key, cached = url.lookup_cache()
+        if cached and cached.is_fresh():
+            if cached.location:
+                return await self.request(url.follow_redirect(cached.location, redirects), result, redirects + 1)
+            result.from_cache = True
+            return cached.status, cached.body()
+        if redirects:
+            return await self.fetch_network(url, result, cache_key, cached, redirects)
+        # A URL that is already being fetched by this batch is fetched once
+        flight = self.flights.get(cache_key)
+        if flight is not None:
+            return await asyncio.shield(flight)
+        flight = self.flights[cache_key] = asyncio.get_running_loop().create_future()
+        try:
+            outcome = await self.fetch_network(url, result, cache_key, cached, redirects)
+        except BaseException as e:
+            flight.set_exception(e)
+            flight.exception()  # Retrieved, even if nobody else was waiting
+            raise
+        finally:
+            del self.flights[cache_key]
+        flight.set_result(outcome)
+        return outcome
+
+    async def fetch_network(self, url, result, cache_key, cached, redirects):
+        # Exchange one request for url and apply the response to the cache, following redirects
+        status, response_headers, content, encoded = await self.exchange(url, url.build_request(self.user_agent, cached))
+        if status == 304 and cached:
+            result.from_cache = True
+            return cached.status, url.revalidated(cache_key, cached, response_headers)
+        if status in REDIRECT_STATUSES:
+            new_url = url.redirect_target(response_headers)
+            url.store_redirect(cache_key, status, response_headers, new_url)
+            return await self.request(url.follow_redirect(new_url, redirects), result, redirects + 1)
+        url.store_response(cache_key, cached, status, response_headers, content, encoded)
+        return status, content
+
+    async def exchange(self, url, request):
+        # Send one request on a pooled connection and read the whole response
+        key = (url.scheme, url.host, url.port)
+        limit = self.host_limits.setdefault(key, asyncio.Semaphore(self.per_host))
+        async with limit:
+            retried = False
+            while True:
+                reader, writer, reused = await self.acquire(key, fresh=retried)
+                try:
+                    writer.write(request)
+                    await asyncio.wait_for(writer.drain(), SOCKET_TIMEOUT)
+                    statusline = await asyncio.wait_for(reader.readline(), SOCKET_TIMEOUT)
+                except (OSError, asyncio.TimeoutError) as e:
+                    writer.close()
+                    if reused and not retried:
+                        retried = True
+                        continue
+                    raise ConnectionError(f"Error sending request: {e}")
+                if not statusline:
+                    writer.close()
+                    if reused and not retried:
+                        retried = True  # Kept-alive connection dropped, retry on a new one
+                        continue
+                    raise ValueError("No server answer")
                 break
             try:
-                header, value = line.split(":", 1)
-                response_headers[header.casefold()] = value.strip()
-            except ValueError:
-                print(f"Invalid header ignored: '{line}'")
-                continue
-        # Handle redirects
-        if redirects_number <= redirects_limit and status in (301, 302, 303, 307, 308):
-            redirects_number += 1
-            new_url = response_headers.get("location", "").strip()
-            if not new_url:
-                s.close()
-                open_sockets.pop(socket_key, None)
-                raise ValueError(f"Redirect response missing 'Location' header")
-            if "://" in new_url:
-                new_url = new_url
-            elif new_url[:1] == "/":
-                new_url = self.scheme + "://" + self.host + new_url
+                statusline = statusline.decode("utf8").strip()
+                try:
+                    version, status, explanation = statusline.split(" ", 2)
+                    status = int(status)
+                except ValueError:
+                    raise ValueError(f"Status line invalid: {statusline}")
+                # Parse response headers
+                response_headers = {}
+                while True:
+                    line = (await asyncio.wait_for(reader.readline(), SOCKET_TIMEOUT)).decode("utf8").strip()
+                    if line == "":
+                        break
+                    parse_header_line(line, response_headers)
+                body = ResponseBody(None, response_headers, status)
+                chunks, complete = await self.read_raw(reader, body)
+                content = bytearray()
+                for data in body.decoded(chunks):
+                    content += data
+            except BaseException as e:
+                writer.close()
+                if isinstance(e, (OSError, asyncio.TimeoutError)):
+                    raise ConnectionError(f"Error reading response: {e}")
+                raise
+            # Return the connection to the pool, or close it if the server requests
+            if complete and response_headers.get("connection", "").lower() != "close":
+                self.idle.setdefault(key, []).append((reader, writer))
             else:
-                new_url = self.scheme + "://" + self.host + "/" + new_url
-            if response_headers.get("Connection", "").lower() == "close":
-                s.close()
-                open_sockets.pop(socket_key, None)
-            print(f"Redirecting to: '{new_url}'...")
-            return URL(new_url).request(user_agent)
-        if redirects_number >= redirects_limit:
+                writer.close()
+            return status, response_headers, content, body.encoded
+
+    async def acquire(self, key, fresh=False):
+        # Return (reader, writer, reused), reusing an idle connection that is still open
+        idle = self.idle.get(key, [])
+        while idle and not fresh:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        try:
+            addresses = resolver.lookup(host, port)
+            if addresses is None:
+                # getaddrinfo blocks, so a lookup that misses the cache runs on a thread
+                addresses = await asyncio.get_running_loop().run_in_executor(None, resolver.resolve, host, port)
+        except socket.gaierror as e:
+            raise ConnectionError(f"Error resolving host {host}: {e}")
+        start = time.perf_counter()
+        try:
+            s, address = await asyncio.wait_for(self.connect(addresses), SOCKET_TIMEOUT)
+            resolver.prefer(host, port, address)
+            tracer.record("connect", start, time.perf_counter() - start, host=host, port=port, address=address[1][0])
+        except asyncio.TimeoutError:
+            resolver.forget(host, port)
+            raise ConnectionError("Error connecting: Timeout")
+        except OSError as e:
+            resolver.forget(host, port)
+            raise ConnectionError(f"Error connecting: {e}")
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                sock=s,
+                ssl=get_ssl_context() if scheme == "https" else None,
+                server_hostname=host if scheme == "https" else None,
+            ), SOCKET_TIMEOUT)
+        except asyncio.TimeoutError:
             s.close()
-            open_sockets.pop(socket_key, None)
-            raise ValueError("Redirects limit reached")
-        # Read response body
-        content = b""
-        if "transfer-encoding" in response_headers and response_headers["transfer-encoding"].strip().lower() == "chunked":
-            print("Chunked encoding detected")
+            raise ConnectionError("Error connecting: Timeout")
+        except (ssl.SSLError, OSError) as e:
+            s.close()
+            raise ConnectionError(f"SSL Error: {e}")
+        if scheme == "https":
+            tracer.record("tls", start, time.perf_counter() - start, host=host)
+        tracer.mark("socket_new", host=host)
+        return reader, writer, False
+
+    async def connect(self, addresses, delay=HAPPY_EYEBALLS_DELAY):
+        # asyncio version of connect_happy_eyeballs, returns (socket, address)
+        loop = asyncio.get_running_loop()
+        remaining = list(addresses)
+        attempts = {}  # connect task -> (socket, address)
+        error = OSError("No addresses to connect to")
+        try:
+            while remaining or attempts:
+                if remaining:
+                    family, address = remaining.pop(0)
+                    s = socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+                    s.setblocking(False)
+                    attempts[asyncio.ensure_future(loop.sock_connect(s, address))] = (s, (family, address))
+                # Wait for an attempt to finish, or until it's time to start the next one
+                done, _ = await asyncio.wait(list(attempts), timeout=delay if remaining else None, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    s, address = attempts.pop(task)
+                    if task.exception() is None:
+                        return s, address
+                    s.close()
+                    error = task.exception()
+            raise error
+        finally:
+            for task, (s, address) in attempts.items():
+                task.cancel()
+                s.close()
+
+    async def read_raw(self, reader, body):
+        # Read the still encoded body using the framing ResponseBody worked out;
+        # returns (chunks, complete) where complete means the connection can be reused
+        chunks = []
+        received = 0
+        if not body.has_body:
+            return chunks, True
+        if body.chunked:
             while True:
-                chunk_size = response.readline().decode("utf8").strip()
-                if not chunk_size:
-                    break
+                line = (await asyncio.wait_for(reader.readline(), SOCKET_TIMEOUT)).decode("utf8").strip()
+                if not line:
+                    return chunks, False
                 try:
-                    chunk_size = int(chunk_size, 16)
+                    chunk_size = int(line.split(";", 1)[0], 16)
                 except ValueError:
-                    s.close()
-                    open_sockets.pop(socket_key, None)
-                    raise ValueError(f"Chunk size invalid: '{chunk_size}'")
+                    raise ValueError(f"Chunk size invalid: '{line}'")
                 if chunk_size == 0:
-                    response.readline()
-                    break
-                content += response.read(chunk_size)
-                response.readline()
-        elif "content-length" in response_headers:
-            content_length = int(response_headers["content-length"])
-            content = response.read(content_length)
-        else:
-            content = response.read()
-        # Handle gzip compression
-        if response_headers.get("content-encoding", "").lower() == "gzip":
-            print("Gzip compression detected")
+                    while (await asyncio.wait_for(reader.readline(), SOCKET_TIMEOUT)).strip():
+                        pass
+                    return chunks, True
+                received = await self.read_sized(reader, body, chunk_size, chunks, received)
+                if received is None:
+                    return chunks, False
+                await asyncio.wait_for(reader.readline(), SOCKET_TIMEOUT)
+        elif "content-length" in body.headers:
             try:
-                content = gzip.decompress(content)
-            except gzip.BadGzipFile as e:
-                s.close()
-                open_sockets.pop(socket_key, None)
-                raise ValueError(f"Error decompressing gzip content: {e}")
-        if response_headers.get("transfer-encoding", "").lower() == "gzip":
-            print("Gzip transfer-encoding detected")
-            try:
-                content = gzip.decompress(content)
-            except gzip.BadGzipFile as e:
-                s.close()
-                open_sockets.pop(socket_key, None)
-                raise ValueError(f"Error decompressing gzip transfer-encoding: {e}")
-        # Close socket if server requests
-        if response_headers.get("connection", "").lower() == "close":
-            s.close()
-            open_sockets.pop(socket_key, None)
-        # Cache response if applicable
-        if status in [200, 301, 404]:
-            cache_control = response_headers.get("cache-control", "").lower()
-            cache_key = (self.scheme, self.host, self.port, self.path)
-            if "no-store" not in cache_control:
-                max_age = None
-                for directive in cache_control.split(","):
-                    directive = directive.strip()
-                    if directive.startswith("max-age="):
-                        try:
-                            max_age = int(directive.split("=")[1])
-                            break
-                        except (IndexError, ValueError):
-                            continue
-                if max_age is None or not cache_control:
-                    expiry = time.time() + max_age if max_age is not None else None
-                    cached_responses[cache_key] = (content, expiry)
-                    print(f"Caching response for {self.scheme}://{self.host}{self.path}")
-        return content.decode("utf8")
+                remaining = int(body.headers["content-length"])
+            except ValueError:
+                raise ValueError(f"Content-Length invalid: '{body.headers['content-length']}'")
+            return chunks, await self.read_sized(reader, body, remaining, chunks, received) is not None
+        else:
+            while True:
+                data = await asyncio.wait_for(reader.read(BODY_CHUNK_SIZE), SOCKET_TIMEOUT)
+                if not data:
+                    return chunks, False
+                received = body.check_size(received, data)
+                chunks.append(data)
+
+    async def read_sized(self, reader, body, size, chunks, received):
+        # Read size bytes into chunks a piece at a time, so a huge announced size fails the
+        # body size check before it's in memory. Returns the bytes received so far, or
+        # None if the connection ended first
+        while size > 0:
+            data = await asyncio.wait_for(reader.read(min(size, BODY_CHUNK_SIZE)), SOCKET_TIMEOUT)
+            if not data:
+                return None
+            received = body.check_size(received, data)
+            chunks.append(data)
+            size -= len(data)
+        return received
+
+    def close(self):
+        for idle in self.idle.values():
+            for reader, writer in idle:
+                writer.close()
+        self.idle.clear()
+
+def fetch_batch(urls, per_host=MAX_CONNECTIONS_PER_HOST, max_concurrency=MAX_CONCURRENT_FETCHES):
+    # Fetch every URL concurrently and print one report line per URL
+    fetcher = AsyncFetcher(per_host, max_concurrency)
+    start = time.perf_counter()
+    results = asyncio.run(fetcher.fetch_all(urls))
+    total = time.perf_counter() - start
+    print(f"{'STATUS':<7} {'BYTES':>10} {'TIME(ms)':>9} {'CACHE':<5}  URL")
+    for result in results:
+        status = result.status if result.error is None else "ERR"
+        cache = "hit" if result.from_cache else ""
+        print(f"{status!s:<7} {result.bytes:>10} {result.elapsed * 1000:>9.1f} {cache:<5}  {result.url}")
+        if result.error:
+            print(f"        {result.error}")
+    failed = sum(1 for result in results if result.error is not None)
+    print(f"{len(results)} URLs, {len(results) - failed} ok, {failed} failed, {sum(r.bytes for r in results)} bytes in {total:.2f}s")
+    return results
+
+MAX_INTERNED_TAG = 16  # Tags up to this length (names without attributes, mostly) share one string
 
 class Text:
+    __slots__ = ("text",)  # Pages have hundreds of thousands of tokens, skip the per-instance dict
+
     def __init__(self, text):
         # Store text content for rendering
         self.text = text
 
 class Tag:
+    __slots__ = ("tag",)
+
     def __init__(self, tag):
-        # Store HTML tag for styling (e.g., <b>, <i>)
-        self.tag = tag
+        # Store HTML tag for styling (e.g., <b>, <i>). Short tags are interned, so
+        # repeated ones share a string and Layout's comparisons hit the identity check
+        self.tag = sys.intern(tag) if len(tag) <= MAX_INTERNED_TAG else tag
 
-def lex(body, view_source=False, right_to_left=False):
-    # Escape HTML tags for view-source mode
-    if view_source:
-        body = body.replace("<", "&lt;").replace(">", "&gt;")
-    out = []  # List to store Text and Tag objects
-    buffer = ""  # Buffer for accumulating characters
-    in_tag = False  # Flag to track if inside an HTML tag
-    entity = ""  # Buffer for HTML entities
-    entities = {"&lt;": "<", "&gt;": ">"}  # Supported HTML entities
-    i = 0
-    while i < len(body):
-        c = body[i]
-        if c == "<":
-            # Start of an HTML tag
-            in_tag = True
-            if buffer:
-                out.append(Text(buffer))  # Save accumulated text
-                buffer = ""
-            if entity:
-                out.append(Text(entity))  # Save accumulated entity
-                entity = ""
-            i += 1
-        elif c == ">":
-            # End of an HTML tag
-            in_tag = False
-            out.append(Tag(buffer))  # Save tag
+PARTIAL_TEXT_SIZE = 2048  # Pending text length after which an incremental lexer emits part of a text run
+PARTIAL_TEXT_LIMIT = 256 * 1024  # Pending text emitted even with nowhere to cut it, splitting a word
+# Where a text run can be cut into two Text tokens that lay out like the whole run: after
+# a space between two words of a line, or before a line break ending a line with words.
+# Right-to-left lines are reversed whole, so they're only cut at line breaks
+TEXT_CUT_RE = re.compile(r"(?<=\S )(?=\S)|(?<=\S)(?=\n)")
+LINE_CUT_RE = re.compile(r"(?<=\S)(?=\n)")
+CENTERING_TAGS = {"h1 class=\"title\"": True, "/h1": False}  # Tags starting and ending a centered title, as in STYLE_TAGS
+
+# Precomputed tables for the regex-driven lexer
+ENTITIES = {"&" + name: value for name, value in html.entities.html5.items() if name.endswith(";")}  # Named entities, e.g. "&amp;"
+ENTITY_RE = re.compile(r"&(?:#[0-9]{1,7}|#[xX][0-9a-fA-F]{1,6}|[A-Za-z][A-Za-z0-9]{0,31});")
+PARTIAL_ENTITY_RE = re.compile(r"&(?:#[xX]?[0-9a-fA-F]*|[A-Za-z][A-Za-z0-9]*)?")  # A reference that may continue in the next chunk
+TAG_SPLIT_RE = re.compile(r"([<>])")
+MAX_ENTITY_LENGTH = 34
+
+def decode_entity(match):
+    # Decode one named or numeric character reference, keeping unknown ones as-is
+    entity = match.group()
+    if entity[1] != "#":
+        return ENTITIES.get(entity, entity)
+    if entity[2] in "xX":
+        codepoint = int(entity[3:-1], 16)
+    else:
+        codepoint = int(entity[2:-1])
+    if codepoint == 0 or codepoint > 0x10FFFF or 0xD800 <= codepoint <= 0xDFFF:
+        return "\ufffd"
+    return chr(codepoint)
+
+def decode_entities(text):
+    if "&" not in text:
+        return text
+    return ENTITY_RE.sub(decode_entity, text)
+
+class Lexer:
+    def __init__(self, view_source=False, right_to_left=False, partial_text=False):
+        # Incremental lexer: state is kept across chunks so tags and entities may be split anywhere
+        self.view_source = view_source  # Source is shown as-is: no tags, no entity decoding
+        self.right_to_left = right_to_left
+        self.partial_text = partial_text  # Emit long text runs before their closing tag arrives
+        self.out = []  # Tokens produced since the last feed
+        # Decoded text, or raw tag contents while inside a tag, as the parts from each chunk,
+        # joined only once the token ends so a long run isn't copied on every chunk
+        self.parts = []
+        self.parts_length = 0
+        self.in_tag = False  # Flag to track if inside an HTML tag
+        self.centered = False  # Inside a centered title, whose lines are measured whole so text there isn't cut
+        self.pending = ""  # Undecided tail of the last chunk (an entity that may continue)
+
+    def feed(self, body):
+        # Lex a chunk of text, returning the tokens completed so far
+        if self.view_source:
+            if body:
+                self.parts.append(body)
+                self.parts_length += len(body)
+        else:
+            if self.pending:
+                body = self.pending + body
+                self.pending = ""
+            # Split into [text, delimiter, text, delimiter, ..., tail] in one pass
+            parts = TAG_SPLIT_RE.split(body)
+            append = self.out.append
+            held = self.parts
+            held_length = self.parts_length
             buffer = ""
-            if entity:
-                out.append(Text(entity))  # Save accumulated entity
-                entity = ""
-            i += 1
-        elif not in_tag:
-            if c == "&":
-                # Start of an HTML entity
-                entity = "&"
-                i += 1
-                while i < len(body) and body[i] != ";" and len(entity) < 5:
-                    entity += body[i]
-                    i += 1
-                if i < len(body) and body[i] == ";":
-                    entity += ";"
-                    i += 1
-                    if entity in entities:
-                        buffer += entities[entity]  # Decode known entity
-                    else:
-                        buffer += entity  # Keep unknown entity as-is
-                    entity = ""
+            if held and len(parts) > 1:
+                # The first delimiter ends the token the earlier chunks started
+                buffer = "".join(held)
+                held = []
+                held_length = 0
+            started_in_tag = in_tag = self.in_tag
+            for segment, delimiter in zip(parts[0::2], parts[1::2]):
+                if in_tag:
+                    # Tag contents are kept raw up to the closing ">"
+                    buffer += segment
+                    if delimiter == ">":
+                        append(Tag(buffer))
+                        in_tag = False
+                    elif buffer:
+                        # A "<" inside a tag turns what came before it into text
+                        append(Text(buffer))
                 else:
-                    buffer += entity  # Append invalid entity
-                    entity = ""
-            else:
-                if entity:
-                    buffer += entity  # Append any accumulated entity
-                    entity = ""
-                buffer += c  # Add character to buffer
-                i += 1
-        else:
-            if entity:
-                buffer += entity  # Append entity inside tag
-                entity = ""
-            buffer += c  # Add character to tag buffer
-            i += 1
-    if not in_tag and buffer:
-        out.append(Text(buffer))  # Save final text buffer
-    if entity:
-        out.append(Text(entity))  # Save final entity
-    # Handle right-to-left text by reversing lines
+                    if segment:
+                        buffer += decode_entities(segment) if "&" in segment else segment
+                    if delimiter == "<":
+                        # Start of an HTML tag
+                        if buffer:
+                            append(Text(buffer))  # Save accumulated text
+                        in_tag = True
+                    else:
+                        # A ">" outside a tag closes a tag made of the pending text
+                        append(Tag(buffer))
+                buffer = ""
+            # The tail has no delimiter after it yet
+            tail = parts[-1]
+            if in_tag:
+                buffer += tail
+            elif tail:
+                # Hold back an entity cut in half by the end of the chunk
+                amp = tail.rfind("&", max(0, len(tail) - MAX_ENTITY_LENGTH))
+                if amp != -1 and PARTIAL_ENTITY_RE.fullmatch(tail, amp):
+                    self.pending = tail[amp:]
+                    tail = tail[:amp]
+                buffer += decode_entities(tail)
+            if buffer:
+                held.append(buffer)
+                held_length += len(buffer)
+            self.parts = held
+            self.parts_length = held_length
+            self.in_tag = in_tag
+            if self.partial_text and (started_in_tag or "h1" in body):
+                # Only a tag completed in this chunk can start or end a centered title
+                for token in reversed(self.out):
+                    if isinstance(token, Tag) and token.tag in CENTERING_TAGS:
+                        self.centered = CENTERING_TAGS[token.tag]
+                        break
+        if self.partial_text and not self.in_tag and self.parts_length >= PARTIAL_TEXT_SIZE:
+            self.emit_partial_text()
+        return self.take()
+
+    def emit_partial_text(self):
+        # Emit the pending text up to its last cut (see TEXT_CUT_RE), in runs of about
+        # PARTIAL_TEXT_SIZE characters that each end at a cut, so they lay out exactly
+        # like the unsplit text. Only the newest part is searched, the earlier ones were
+        # when they arrived; past PARTIAL_TEXT_LIMIT everything is emitted regardless
+        parts = self.parts
+        before = parts[-2][-2:] if len(parts) > 1 else ""  # Context for a cut at the start of the newest part
+        window = before + parts[-1]
+        cut = -1 if self.centered else last_text_cut(window, self.right_to_left)
+        if cut < max(1, len(before)):
+            if self.parts_length < PARTIAL_TEXT_LIMIT:
+                return
+            cut = len(window)
+        text = "".join(parts)
+        end = len(text) - len(window) + cut
+        cut_re = LINE_CUT_RE if self.right_to_left else TEXT_CUT_RE
+        start = 0
+        while True:
+            match = cut_re.search(text, start + PARTIAL_TEXT_SIZE, end)
+            if match is None:
+                break
+            self.out.append(Text(text[start:match.start()]))
+            start = match.start()
+        self.out.append(Text(text[start:end]))
+        rest = text[end:]
+        self.parts = [rest] if rest else []
+        self.parts_length = len(rest)
+
+    def take(self):
+        out = self.out
+        self.out = []
+        # Handle right-to-left text by reversing lines
+        if self.right_to_left:
+            for token in out:
+                if isinstance(token, Text):
+                    lines = token.text.split("\n")
+                    reversed_lines = [line[::-1] for line in lines]
+                    token.text = "\n".join(reversed_lines)
+        return out
+
+    def close(self):
+        # Flush whatever is pending at the end of the document
+        if self.pending:
+            self.parts.append(self.pending)  # Append unfinished entity as-is
+            self.pending = ""
+        if not self.in_tag and self.parts:
+            self.out.append(Text("".join(self.parts)))  # Save final text buffer
+        self.parts = []
+        self.parts_length = 0
+        return self.take()
+
+def last_text_cut(text, right_to_left):
+    # Position of the last cut in text (see TEXT_CUT_RE), or -1
+    newline = text.rfind("\n")
+    while newline > 0 and text[newline - 1].isspace():
+        newline = text.rfind("\n", 0, newline)
+    if newline == 0:
+        newline = -1
     if right_to_left:
-        reversed_out = []
-        for item in out:
-            if isinstance(item, Text):
-                lines = item.text.split("\n")
-                reversed_lines = [line[::-1] for line in lines]
-                item.text = "\n".join(reversed_lines)
-            reversed_out.append(item)
-        out = reversed_out
-    return out
+        return newline
+    space = text.rfind(" ", 0, len(text) - 1)
+    while space > 0 and (text[space - 1].isspace() or text[space + 1].isspace()):
+        space = text.rfind(" ", 0, space)
+    return max(newline, space + 1 if space > 0 else -1)
+
+def lex(body, view_source=False, right_to_left=False):
+    with tracer.span("lex", chars=len(body)):
+        lexer = Lexer(view_source, right_to_left)
+        return lexer.feed(body) + lexer.close()
+
+ATTRIBUTE_RE = re.compile(r"""([^\s=/>"']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+)))?""")
+URL_SCHEME_RE = re.compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*:")
+
+def tag_attributes(tag):
+    # Split the text of a Tag into its lowercase name and a dict of attributes
+    parts = tag.split(None, 1)
+    if not parts:
+        return "", {}
+    attributes = {}
+    for match in ATTRIBUTE_RE.finditer(parts[1] if len(parts) > 1 else ""):
+        name, double_quoted, single_quoted, unquoted = match.groups()
+        value = next((v for v in (double_quoted, single_quoted, unquoted) if v is not None), "")
+        attributes.setdefault(name.lower(), decode_entities(value))  # The first occurrence wins
+    return parts[0].lower(), attributes
+
+def link_targets(tokens, base_url, limit=MAX_PREFETCH_LINKS):
+    # Links worth fetching ahead, from a page's tokens: <link rel=prefetch> targets
+    # first, then <a href> in document order. Returns (absolute URLs, preconnect origins)
+    prefetch, anchors, preconnect = [], [], []
+    for tok in tokens:
+        if not isinstance(tok, Tag) or tok.tag[:1] not in "aAlL":
+            continue
+        name, attributes = tag_attributes(tok.tag)
+        href = attributes.get("href", "").strip()
+        if not href or href.startswith("#"):
+            continue
+        if name == "link":
+            rel = attributes.get("rel", "").lower().split()
+            if "preconnect" in rel:
+                preconnect.append(href)
+            if "prefetch" in rel:
+                prefetch.append(href)
+        elif name == "a":
+            anchors.append(href)
+    def absolute(href):
+        # None for links that aren't http(s), or can't be resolved against a local page
+        if URL_SCHEME_RE.match(href):
+            return href if href.lower().startswith(("http://", "https://")) else None
+        if base_url.scheme not in ("http", "https"):
+            return None
+        return base_url.resolve(href)
+    def parse(target):
+        # None for a link URL this browser can't parse, like one with a port that isn't a number
+        try:
+            return URL(target)
+        except (ValueError, AssertionError):
+            return None
+    page = base_url.resolve(base_url.path) if base_url.scheme in ("http", "https") else None
+    urls = []
+    for href in prefetch + anchors:
+        target = absolute(href)
+        if target and target != page and target not in urls and parse(target) is not None:
+            urls.append(target)
+            if len(urls) >= limit:
+                break
+    origins = []
+    for href in preconnect:
+        target = absolute(href)
+        url = parse(target) if target else None
+        if url is not None and (url.scheme, url.host, url.port) not in origins:
+            origins.append((url.scheme, url.host, url.port))
+    return urls, origins
+
+def prefetch_links(tokens, base_url, user_agent="Vares Browser"):
+    # Warm the connection pool and the cache with what a loaded page links to, so
+    # following a link usually hits the cache. Runs on a background thread; failures
+    # are only logged
+    if getattr(base_url, "scheme", None) in (None, "data"):
+        return  # about:blank and data: pages have no links worth fetching ahead
+    urls, origins = link_targets(tokens, base_url)
+    with tracer.span("prefetch", links=len(urls), preconnects=len(origins)):
+        for scheme, host, port in origins:
+            try:
+                s, reused = connection_pool.acquire(scheme, host, port)
+                connection_pool.release(s)
+            except ConnectionError as e:
+                log(f"Preconnect to {scheme}://{host} failed: {e}")
+        by_origin = collections.OrderedDict()  # Origin -> paths, requested together
+        for target in urls:
+            try:
+                url = URL(target)
+            except (ValueError, AssertionError) as e:
+                log(f"Not prefetching {target}: {e}")
+                continue
+            by_origin.setdefault(url.origin(), []).append(url.path)
+        for origin, paths in by_origin.items():
+            log(f"Prefetching {len(paths)} links from {origin}...")
+            for path, result in zip(paths, URL(origin + "/").request_many(paths, user_agent)):
+                if isinstance(result, Exception):
+                    log(f"Prefetch of {origin}{path} failed: {result}")
+
+class TkFontBackend:
+    def get_font(self, size, weight, style):
+        # Real Tk fonts; needs a Tk root and a display
+        key = (size, weight, style)
+        if key not in FONTS:
+            font = tkinter.font.Font(
+                size=size,
+                weight=weight,
+                slant=style
+            )
+            label = tkinter.Label(font=font)
+            FONTS[key] = (font, label)
+            font_keys[id(font)] = key
+        return FONTS[key][0]
+
+# Advance widths of printable ASCII in 1/1000 em, from a Helvetica-style sans serif face
+GLYPH_ADVANCES = dict(zip(
+    " !\"#$%&'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`abcdefghijklmnopqrstuvwxyz{|}~",
+    [278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+     556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+     1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+     667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+     333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+     556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584],
+))
+DEFAULT_ADVANCE = 556  # Any other narrow character
+WIDE_ADVANCE = 1000  # East Asian wide and fullwidth characters
+BOLD_ADVANCE_SCALE = 1.07
+HEADLESS_ASCENT, HEADLESS_DESCENT = 0.905, 0.212  # In em
+HEADLESS_PIXELS_PER_POINT = 96 / 72  # Tk's usual scaling on a 96 DPI screen
+
+class HeadlessFont:
+    def __init__(self, size, weight, style):
+        # Deterministic stand-in for tkinter.font.Font with the same measure/metrics API
+        self.size = size
+        self.weight = weight
+        self.style = style
+        self.name = f"headless-{size}-{weight}-{style}"
+        self.pixels = size * HEADLESS_PIXELS_PER_POINT  # Em size in pixels
+        self.scale = self.pixels / 1000 * (BOLD_ADVANCE_SCALE if weight == "bold" else 1)
+        ascent = round(self.pixels * HEADLESS_ASCENT)
+        descent = round(self.pixels * HEADLESS_DESCENT)
+        self.font_metrics = {"ascent": ascent, "descent": descent, "linespace": ascent + descent, "fixed": 0}
+
+    def __str__(self):
+        return self.name
+
+    def advance(self, char):
+        width = GLYPH_ADVANCES.get(char)
+        if width is None:
+            if unicodedata.combining(char):
+                width = 0
+            elif unicodedata.east_asian_width(char) in ("W", "F"):
+                width = WIDE_ADVANCE
+            else:
+                width = DEFAULT_ADVANCE
+        return width
+
+    def measure(self, text):
+        return round(sum(self.advance(char) for char in text) * self.scale)
+
+    def metrics(self, *options):
+        if options:
+            return self.font_metrics[options[0]]
+        return dict(self.font_metrics)
+
+class HeadlessFontBackend:
+    def __init__(self):
+        self.fonts = {}
+
+    def get_font(self, size, weight, style):
+        key = (size, weight, style)
+        if key not in self.fonts:
+            self.fonts[key] = HeadlessFont(size, weight, style)
+            font_keys[id(self.fonts[key])] = key
+        return self.fonts[key]
+
+# Font backend used by Layout; Tk by default, headless when asked or when Tk is missing
+if os.environ.get("VARES_FONT_BACKEND") == "headless" or tkinter is None:
+    font_backend = HeadlessFontBackend()
+else:
+    font_backend = TkFontBackend()
+
+def set_font_backend(backend):
+    global font_backend
+    font_backend = backend
 
 def get_font(size, weight, style):
-    key = (size, weight, style)
-    if key not in FONTS:
-        font = tkinter.font.Font(
-            size=size,
-            weight=weight,
-            slant=style
-        )
-        label = tkinter.Label(font=font)
-        FONTS[key] = (font, label)
-    return FONTS[key][0]
+    return font_backend.get_font(size, weight, style)
+
+MEASURE_CACHE_SIZE = 100000  # Maximum (font, text) widths kept by the text measurer
+
+class TextMeasurer:
+    def __init__(self, max_entries=MEASURE_CACHE_SIZE):
+        # Memoizes font.measure and font.metrics, which are round trips to Tk
+        self.max_entries = max_entries
+        self.widths = {}  # (font name, text) -> width, oldest first
+        self.font_metrics = {}  # font name -> metrics dict
+        self.hits = 0
+        self.misses = 0
+
+    def measure(self, font, text):
+        key = (str(font), text)
+        width = self.widths.get(key)
+        if width is not None:
+            self.hits += 1
+            return width
+        self.misses += 1
+        width = font.measure(text)
+        if len(self.widths) >= self.max_entries:
+            del self.widths[next(iter(self.widths))]  # Evict the oldest entry
+        self.widths[key] = width
+        return width
+
+    def metrics(self, font):
+        name = str(font)
+        metrics = self.font_metrics.get(name)
+        if metrics is None:
+            metrics = font.metrics()
+            self.font_metrics[name] = metrics
+        return metrics
+
+    def char_widths(self, font, word):
+        # Width of each character, so prefix widths are running sums instead of one measure per prefix
+        return [self.measure(font, char) for char in word]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self.widths),
+            "fonts": len(self.font_metrics),
+        }
+
+text_measurer = TextMeasurer()  # Shared by every layout and the canvas
+
+font_table = []  # Font id -> font object, for columnar display lists
+font_ids = {}  # id(font) -> font id; fonts are cached for the whole run, so their ids stay valid
+font_table_lock = threading.Lock()
+font_keys = {}  # id(font) -> (size, weight, style) it was made for, filled by the font backends
+
+def font_id(font):
+    fid = font_ids.get(id(font))
+    if fid is None:
+        with font_table_lock:
+            fid = font_ids.get(id(font))
+            if fid is None:
+                fid = len(font_table)
+                font_table.append(font)
+                font_ids[id(font)] = fid
+    return fid
+
+class DisplayList:
+    # Display list stored as columns rather than a tuple per word: x and y in arrays,
+    # a font id per word instead of the font object, and the word strings, with each
+    # distinct word kept once. Indexing still gives ("text", x, y, word, font)
+    __slots__ = ("xs", "ys", "font_ids", "words", "strings")
+
+    def __init__(self):
+        self.xs = array.array("d")
+        self.ys = array.array("d")
+        self.font_ids = array.array("H")
+        self.words = []
+        self.strings = {}  # Distinct words, so repeated words share one string
+
+    def append(self, x, y, word, font):
+        self.xs.append(x)
+        self.ys.append(y)
+        self.font_ids.append(font_id(font))
+        self.words.append(self.strings.setdefault(word, word))
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, i):
+        return ("text", self.xs[i], self.ys[i], self.words[i], font_table[self.font_ids[i]])
+
+    def __iter__(self):
+        for i in range(len(self.words)):
+            yield self[i]
+
+    def font(self, i):
+        return font_table[self.font_ids[i]]
+
+    def extend_shifted(self, other, start, end, dy):
+        # Append the items start:end of other, moved down by dy
+        self.xs.extend(other.xs[start:end])
+        self.ys.extend(array.array("d", [y + dy for y in other.ys[start:end]]))
+        self.font_ids.extend(other.font_ids[start:end])
+        self.words.extend(other.words[start:end])
+
+# Tags that only change the style state of a Layout, as (attribute, value) pairs
+STYLE_TAGS = {
+    "h1 class=\"title\"": (("centered_text", True), ("size", 29)),
+    "/h1": (("centered_text", False), ("size", 14)),
+    "sup": (("size", 7), ("sup_tag", True)),
+    "/sup": (("size", 14), ("sup_tag", False)),
+    "i": (("style", "italic"),),
+    "/i": (("style", "roman"),),
+    "b": (("weight", "bold"),),
+    "/b": (("weight", "normal"),),
+    "small": (("size", 10),),
+    "/small": (("size", 14),),
+    "big": (("size", 18),),
+    "/big": (("size", 14),),
+}
+STYLE_FIELDS = ("weight", "style", "size", "centered_text", "sup_tag")
+
+class LaidOutBlock:
+    __slots__ = ("display_list", "start", "end", "top", "height", "chars", "end_style")
+
+    def __init__(self, display_list, start, end, top, height, chars, end_style):
+        # A block of tokens laid out from a fresh line at y = top, as the items start:end
+        # of the display list of the layout that recorded it, which only ever grows;
+        # height is how far it moves the cursor down
+        self.display_list = display_list
+        self.start = start
+        self.end = end
+        self.top = top
+        self.height = height
+        self.chars = chars  # Characters of text in the block
+        self.end_style = end_style  # Style state after the block, as STYLE_FIELDS
+
+class BlockCache:
+    def __init__(self, max_items=BLOCK_CACHE_ITEMS):
+        # Laid out blocks by block_key, least recently used first, within a budget of the
+        # words they refer to. Blocks keep the display lists they point into alive, which
+        # mostly belong to layouts still kept by the browser
+        self.max_items = max_items
+        self.entries = collections.OrderedDict()
+        self.total_items = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            block = self.entries.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return block
+
+    def put(self, key, block):
+        if block.end - block.start > self.max_items:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_items -= old.end - old.start
+            self.entries[key] = block
+            self.total_items += block.end - block.start
+            while self.total_items > self.max_items:
+                key, old = self.entries.popitem(last=False)
+                self.total_items -= old.end - old.start
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_items = 0
+
+block_cache = BlockCache()  # Shared by every layout, so reloads and revisited widths reuse blocks
+
+def find_block(tokens, start):
+    # The block starting at start, as (end, content): it ends just past the next /p or
+    # br, and its content is the strings of its tokens followed by a bit mask of which
+    # ones are tags. None for the last block, which has no such end, and for blocks too
+    # long to memoize
+    content = []
+    tags = 0
+    chars = 0
+    for i in range(start, len(tokens)):
+        tok = tokens[i]
+        if type(tok) is Text:
+            chars += len(tok.text)
+            if chars > BLOCK_MAX_CHARS:
+                return None
+            content.append(tok.text)
+        else:
+            tags |= 1 << (i - start)
+            content.append(tok.tag)
+            if tok.tag == "/p" or tok.tag == "br":
+                content.append(tags)
+                return i + 1, tuple(content)
+    return None
+
+def block_key(content, style, width, text_right_to_left):
+    # A block lays out the same wherever it appears if its content, the style state
+    # it starts in, the width, direction and fonts are the same
+    return (content, style, width, text_right_to_left, font_backend)
+
+def line_item_y(item):
+    return item[0]
 
 class Layout:
-    def __init__(self, tokens, width, text_right_to_left):
-        self.display_list = []
+    def __init__(self, tokens, width, text_right_to_left, partial=False, max_height=None, lazy_height=None, memoize=False):
+        self.display_list = DisplayList()
         self.display_lines = []
         self.cursor_x = HSTEP
         self.cursor_y = VSTEP
@@ -404,11 +2338,141 @@ class Layout:
         self.first_content = False  # Flag to track if non-empty content has been rendered
         self.centered_text = False
         self.sup_tag = False
+        self.max_height = max_height  # Stop early once content is taller than this
+        self.overflowed = False  # True if layout stopped at max_height; display_list is then incomplete
+        self.complete = False  # True once every token is laid out and the last line flushed
+        # Lazy layouts keep their tokens and are continued with resume()
+        self.tokens = None
+        self.position = 0  # Index of the next token to lay out
+        self.remainder = None  # Rest of a long text run that was only partly laid out
+        self.text_done = 0  # Characters of text laid out so far
+        self.text_total = None  # Estimated characters of text in all tokens, for estimated_height
+        # A memoizing layout, like the browser's, takes blocks (runs of tokens between
+        # line-ending /p and br tags) from the block cache when they were laid out in the
+        # same state, and records the others for the next layout. One-off layouts skip it
+        self.memoize = memoize
+        self.block_start = False  # Just past a line-ending /p or br, a block starts here
+        self.block = None  # (key, end, top cursor_y, text_done, display list length) of the block being recorded
         if text_right_to_left:
             self.cursor_x = width - HSTEP
+        with tracer.span("layout", width=width, tokens=len(tokens), partial=partial, lazy=lazy_height is not None) as args:
+            if lazy_height is not None or (memoize and not partial and max_height is None):
+                self.tokens = tokens
+                self.resume(lazy_height)
+            else:
+                self.feed(tokens)
+                if not partial and not self.overflowed:
+                    self.finish()
+            args["overflowed"] = self.overflowed
+            args["complete"] = self.complete
+
+    def feed(self, tokens):
+        # Lay out more tokens; completed lines are appended to display_list
         for tok in tokens:
             self.token(tok)
+            if self.max_height is not None and self.biggest_y + VSTEP > self.max_height:
+                self.overflowed = True
+                return
+
+    def finish(self):
+        # Flush the last line once every token has been fed
         self.flush()
+        self.complete = True
+
+    def resume(self, height=None, deadline=None):
+        # Continue a lazy layout until the content is taller than height, the deadline
+        # (a time.perf_counter() value) has passed, or every token is laid out.
+        # Returns True once the layout is complete
+        while not self.complete and self.tokens is not None:
+            if height is not None and self.biggest_y > height:
+                return False
+            if deadline is not None and time.perf_counter() >= deadline:
+                return False
+            if self.block_start:
+                self.block_start = False
+                self.end_block()
+                if self.start_block():
+                    continue
+            tok = self.next_token()
+            if tok is None:
+                self.block = None  # The last block has no end to memoize at
+                self.finish()
+            else:
+                if isinstance(tok, Text):
+                    self.text_done += len(tok.text)
+                self.token(tok)
+        return self.complete
+
+    def style_state(self):
+        return (self.weight, self.style, self.size, self.centered_text, self.sup_tag)
+
+    def start_block(self):
+        # At the start of a block: append it from the block cache, moving past it, or
+        # start recording it. Returns True if it was reused
+        block = find_block(self.tokens, self.position)
+        if block is None:
+            return False
+        end, content = block
+        key = block_key(content, self.style_state(), self.width, self.text_right_to_left)
+        block = block_cache.get(key)
+        if block is None:
+            self.block = (key, end, self.cursor_y, self.text_done, len(self.display_list))
+            return False
+        self.display_list.extend_shifted(block.display_list, block.start, block.end, self.cursor_y - block.top)
+        self.cursor_y += block.height
+        if self.cursor_y > self.biggest_y:
+            self.biggest_y = self.cursor_y
+        self.text_done += block.chars
+        for name, value in zip(STYLE_FIELDS, block.end_style):
+            setattr(self, name, value)
+        self.position = end
+        self.block_start = True  # Blocks end with the /p or br that starts the next one
+        return True
+
+    def end_block(self):
+        # Memoize the block just recorded, which ended on a line-ending /p or br
+        if self.block is None:
+            return
+        key, end, top, text_done, start = self.block
+        self.block = None
+        if self.position != end:
+            return
+        block_cache.put(key, LaidOutBlock(self.display_list, start, len(self.display_list), top, self.cursor_y - top, self.text_done - text_done, self.style_state()))
+
+    def next_token(self):
+        # Next token of a lazy layout. A long text run is cut at a space between two
+        # words of the same line, which lays out like the whole run, so the layout
+        # can stop inside it; centered lines are measured whole and never cut
+        if self.remainder is not None:
+            text = self.remainder
+            self.remainder = None
+        elif self.position < len(self.tokens):
+            tok = self.tokens[self.position]
+            self.position += 1
+            if not isinstance(tok, Text) or len(tok.text) <= PARTIAL_TEXT_SIZE or self.centered_text:
+                return tok
+            text = tok.text
+        else:
+            return None
+        split = text.find(" ", PARTIAL_TEXT_SIZE)
+        while split != -1 and split + 1 < len(text):
+            if not text[split - 1].isspace() and not text[split + 1].isspace():
+                self.remainder = text[split + 1:]
+                return Text(text[:split + 1])
+            split = text.find(" ", split + 1)
+        return Text(text)
+
+    def estimated_height(self):
+        # Height of the content, extrapolated from the share of the text laid out so
+        # far while a lazy layout is incomplete. The text length is estimated from a
+        # fixed number of evenly spaced tokens, so this stays cheap on huge pages
+        if self.complete or not self.tokens or not self.text_done:
+            return self.biggest_y
+        if self.text_total is None:
+            sample = self.tokens[::max(1, len(self.tokens) // ESTIMATE_SAMPLES)]
+            self.text_total = sum(len(tok.text) for tok in sample if isinstance(tok, Text)) * len(self.tokens) / len(sample)
+        share = min(1.0, self.text_done / max(self.text_total, 1))
+        return max(self.biggest_y, self.biggest_y / share)
 
     def token(self, tok):
         if isinstance(tok, Text):
@@ -420,12 +2484,12 @@ class Layout:
                     if self.first_content:
                         self.flush()
                         font = get_font(self.size, self.weight, self.style)
-                        self.cursor_y += font.metrics("linespace") * 1.25
+                        self.cursor_y += text_measurer.metrics(font)["linespace"] * 1.25
                         self.cursor_x = self.width - HSTEP if self.text_right_to_left else HSTEP
                     continue
                 if self.centered_text:
                     font = get_font(self.size, self.weight, self.style)
-                    line_width = font.measure(line)
+                    line_width = text_measurer.measure(font, line)
                     self.cursor_x = (self.width / 2) - (line_width / 2)
                     for word in words:
                         self.word(word)
@@ -437,77 +2501,49 @@ class Layout:
                 if i < len(lines) - 1 and self.first_content:
                     self.flush()
                     font = get_font(self.size, self.weight, self.style)
-                    self.cursor_y += font.metrics("linespace") * 1.25
+                    self.cursor_y += text_measurer.metrics(font)["linespace"] * 1.25
                     self.cursor_x = self.width - HSTEP if self.text_right_to_left else HSTEP
-        elif tok.tag == "br":
-            if self.first_content:
-                self.flush()
-                font = get_font(self.size, self.weight, self.style)
-                self.cursor_y += font.metrics("linespace") * 1.25
-                self.cursor_x = self.width - HSTEP if self.text_right_to_left else HSTEP
-        elif tok.tag == "/p":
+        elif tok.tag == "br" or tok.tag == "/p":
             if self.first_content:
                 self.flush()
                 font = get_font(self.size, self.weight, self.style)
-                self.cursor_y += font.metrics("linespace") * 1.25
+                self.cursor_y += text_measurer.metrics(font)["linespace"] * 1.25
                 self.cursor_x = self.width - HSTEP if self.text_right_to_left else HSTEP
-        elif tok.tag == "h1 class=\"title\"":
-            self.centered_text = True
-            self.size = 29
-        elif tok.tag == "/h1":
-            self.centered_text = False
-            self.size = 14
-        elif tok.tag == "sup":
-            self.size = 7
-            self.sup_tag = True
-        elif tok.tag == "/sup":
-            self.size = 14
-            self.sup_tag = False
-        elif tok.tag == "i":
-            self.style = "italic"
-        elif tok.tag == "/i":
-            self.style = "roman"
-        elif tok.tag == "b":
-            self.weight = "bold"
-        elif tok.tag == "/b":
-            self.weight = "normal"
-        elif tok.tag == "small":
-            self.size = 10
-        elif tok.tag == "/small":
-            self.size = 14
-        elif tok.tag == "big":
-            self.size = 18
-        elif tok.tag == "/big":
-            self.size = 14
+                self.block_start = self.memoize  # The line is ended, what follows lays out the same anywhere
+        else:
+            for name, value in STYLE_TAGS.get(tok.tag, ()):
+                setattr(self, name, value)
         if self.cursor_y > self.biggest_y:
             self.biggest_y = self.cursor_y
 
     def word(self, word):
         font = get_font(self.size, self.weight, self.style)
-        w = font.measure(word)
-        space_width = font.measure(" ")
+        w = text_measurer.measure(font, word)
+        space_width = text_measurer.measure(font, " ")
         available_width = self.width - HSTEP - self.cursor_x if not self.text_right_to_left else self.cursor_x - HSTEP
 
         # Handle long words by breaking them if they exceed the available width
         if w > available_width:
             current_word = ""
-            for char in word:
-                char_width = font.measure(char)
-                if char_width > available_width:
-                    continue
-                if font.measure(current_word + char) > available_width:
+            current_width = 0  # Running sum of the character widths in current_word
+            for char, char_width in zip(word, text_measurer.char_widths(font, word)):
+                if char_width > self.width - 2 * HSTEP:
+                    continue  # Character doesn't fit even on an empty line
+                if current_width + char_width > available_width:
                     if current_word:
-                        self.display_lines.append(("text", self.cursor_x, current_word, font))
-                        self.cursor_x += (-font.measure(current_word) - space_width if self.text_right_to_left else font.measure(current_word) + space_width)
+                        self.display_lines.append(("text", self.cursor_x, current_word, font, self.sup_tag))
+                        self.cursor_x += (-current_width - space_width if self.text_right_to_left else current_width + space_width)
                     self.flush()
                     self.cursor_x = self.width - HSTEP if self.text_right_to_left else HSTEP
                     available_width = self.width - 2 * HSTEP
                     current_word = char
+                    current_width = char_width
                 else:
                     current_word += char
+                    current_width += char_width
             if current_word:
                 word = current_word
-                w = font.measure(word)
+                w = current_width
             else:
                 return
 
@@ -529,33 +2565,319 @@ class Layout:
             # Only advance cursor_y if content has been rendered
             if self.first_content:
                 font = get_font(self.size, self.weight, self.style)
-                self.cursor_y += font.metrics("linespace") * 1.25
+                self.cursor_y += text_measurer.metrics(font)["linespace"] * 1.25
             self.cursor_x = self.width - HSTEP if self.text_right_to_left else HSTEP
             return
-        metrics = [font.metrics() for type, x, word, font, sup in self.display_lines]
+        metrics = [text_measurer.metrics(font) for type, x, word, font, sup in self.display_lines]
         max_ascent = max([metric["ascent"] for metric in metrics])
         baseline = self.cursor_y + 1.25 * max_ascent
-        for typ, x, word, font, sup in self.display_lines:
+        line = []
+        for (typ, x, word, font, sup), metric in zip(self.display_lines, metrics):
             if sup:
-                # Raise superscripted text by half the font's ascent
-                y = baseline - font.metrics("ascent") * 1.5
+                # Raise superscripted text by half the font's ascent, but not above the
+                # top of the line
+                y = max(self.cursor_y, baseline - metric["ascent"] * 1.5)
             else:
-                y = baseline - font.metrics("ascent")
-            self.display_list.append((typ, x, y, word, font))
+                y = baseline - metric["ascent"]
+            line.append((y, x, word, font))
+        # Append the line in y order; every item is below the lines before it, so the
+        # display list's y column stays sorted for the viewport index
+        line.sort(key=line_item_y)
+        for y, x, word, font in line:
+            self.display_list.append(x, y, word, font)
         max_descent = max([metric["descent"] for metric in metrics])
         self.cursor_y = baseline + 1.25 * max_descent
         self.cursor_x = self.width - HSTEP if self.text_right_to_left else HSTEP
         self.display_lines = []
 
+def layout_record(layout):
+    # JSON-ready form of a complete layout: its width and height, a table of its fonts
+    # as (size, weight, style) and its display list as [x, y, font, word] items
+    display_list = layout.display_list
+    fonts = {}  # Font id -> index in the table
+    for fid in display_list.font_ids:
+        fonts.setdefault(fid, len(fonts))
+    return {
+        "width": layout.width,
+        "height": layout.biggest_y,
+        "fonts": [list(font_keys[id(font_table[fid])]) for fid in fonts],
+        "items": [[x, y, fonts[fid], word] for x, y, fid, word in zip(display_list.xs, display_list.ys, display_list.font_ids, display_list.words)],
+    }
+
+def page_url(source):
+    # URL for a batch argument: URLs as given, anything else is a local file
+    if "://" in source or source.startswith(("data:", "about:", "view-source:")):
+        return source
+    return f"file://{os.path.abspath(source)}"
+
+def init_render_worker():
+    # Process pool initializer for render_batch. DiskCache is only safe within one
+    # process, so workers keep responses in their memory cache only
+    global disk_cache
+    set_font_backend(HeadlessFontBackend())
+    disk_cache = DiskCache(None)
+
+def render_page(source, width, height):
+    # Process pool worker for render_batch: fetch, lex and lay out one page the way a
+    # width x height window shows it. Returns (url, error, timing, items, JSON line), the
+    # line holding the display list as [x, y, font, word] items with a table of fonts
+    url = page_url(source)
+    record = {"url": url}
+    timing = {}
+    error = None
+    items = 0
+    try:
+        start = time.perf_counter()
+        parsed = URL(url)
+        body = parsed.request()
+        timing["fetch"] = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        tokens = lex(body, parsed.view_source, parsed.right_to_left_text)
+        timing["lex"] = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        # Same choice of width as Browser.layout_page: narrower by the scrollbar if it doesn't fit
+        layout = Layout(tokens, width, parsed.right_to_left_text, max_height=height)
+        if layout.biggest_y + VSTEP > height:
+            layout = Layout(tokens, width - SCROLLBAR_WIDTH, parsed.right_to_left_text)
+        timing["layout"] = (time.perf_counter() - start) * 1000
+        record.update(layout_record(layout))
+        items = len(layout.display_list)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        record["error"] = error
+    record["timing"] = {step: round(ms, 3) for step, ms in timing.items()}
+    return url, error, timing, items, json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+def render_batch(sources, output, width=800, height=600, processes=None, report=sys.stdout):
+    # Render every URL or file on a process pool with headless fonts, writing one JSON
+    # line per page to output in input order and a timing line per page to report (if
+    # any). Idle workers take the next page from the shared queue, so slow pages don't
+    # hold up the rest; at most RENDER_AHEAD pages per worker wait to be written.
+    # Returns the number of failed pages
+    processes = processes or os.cpu_count() or 1
+    sources = iter(sources)
+    pending = collections.deque()
+    pages = failed = 0
+    start = time.perf_counter()
+    if report:
+        print(f"{'ITEMS':>8} {'FETCH(ms)':>9} {'LEX(ms)':>8} {'LAYOUT(ms)':>10}  URL", file=report)
+    with concurrent.futures.ProcessPoolExecutor(processes, initializer=init_render_worker) as pool:
+        while True:
+            while len(pending) < processes * RENDER_AHEAD:
+                source = next(sources, None)
+                if source is None:
+                    break
+                pending.append(pool.submit(render_page, source, width, height))
+            if not pending:
+                break
+            url, error, timing, items, line = pending.popleft().result()
+            output.write(line + "\n")
+            pages += 1
+            if error:
+                failed += 1
+            if report:
+                times = " ".join(f"{timing[step]:>{size}.1f}" if step in timing else f"{'':>{size}}" for step, size in (("fetch", 9), ("lex", 8), ("layout", 10)))
+                print(f"{items:>8} {times}  {url}", file=report)
+                if error:
+                    print(f"         {error}", file=report)
+    if report:
+        print(f"{pages} pages, {pages - failed} ok, {failed} failed in {time.perf_counter() - start:.2f}s on {processes} processes", file=report)
+    return failed
+
+def font_environment(fonts):
+    # What a layout in these (size, weight, style) fonts depends on besides its text: the
+    # font backend and, per font, the width of a probe text and the vertical metrics,
+    # which change with the installed font family and the screen scaling
+    environment = [type(font_backend).__name__]
+    for key in fonts:
+        font = get_font(*key)
+        metrics = text_measurer.metrics(font)
+        environment.append([text_measurer.measure(font, SNAPSHOT_PROBE_TEXT), metrics["ascent"], metrics["descent"], metrics["linespace"]])
+    return environment
+
+def save_snapshot(path, source, width, height, text_right_to_left, layout):
+    # Save the complete layout of the local file source, shown in a width x height
+    # window, for load_snapshot on a later start
+    try:
+        stat = os.stat(source)
+        record = {
+            "source": os.path.abspath(source),
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "window": [width, height],
+            "right_to_left": text_right_to_left,
+        }
+        record.update(layout_record(layout))
+        record["environment"] = font_environment(record["fonts"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf8") as f:
+            json.dump(record, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Error writing snapshot: {e}", file=sys.stderr)
+
+def load_snapshot(path, source, width, height, text_right_to_left):
+    # The layout save_snapshot saved for source, or None if there's none or the file,
+    # the window size, the direction or the fonts changed since
+    try:
+        with open(path, "r", encoding="utf8") as f:
+            record = json.load(f)
+        stat = os.stat(source)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable snapshot: {e}", file=sys.stderr)
+        return None
+    try:
+        key = (record["source"], record["mtime"], record["size"], record["window"], record["right_to_left"])
+        if key != (os.path.abspath(source), stat.st_mtime_ns, stat.st_size, [width, height], text_right_to_left):
+            return None
+        if record["environment"] != font_environment(record["fonts"]):
+            return None
+        fonts = [get_font(*font) for font in record["fonts"]]
+        layout = Layout([], record["width"], text_right_to_left)
+        for x, y, font, word in record["items"]:
+            layout.display_list.append(x, y, word, fonts[font])
+        layout.biggest_y = record["height"]
+    except (KeyError, TypeError, ValueError, IndexError) as e:
+        print(f"Ignoring unreadable snapshot: {e}", file=sys.stderr)
+        return None
+    return layout
+
+class Page:
+    def __init__(self, url):
+        # A history entry. Its tokens and the layout it was shown with are kept while it
+        # is in the page cache, so going back to it skips fetching, lexing and layout
+        self.url = url
+        self.loaded = False  # The whole page arrived, so its tokens can be reused
+        self.text = None
+        self.layout = None
+        self.size = None  # Window size the layout was chosen for
+        self.scroll = 0
+        self.bytes = 0  # Estimated memory held by text and layout
+
+    def forget(self):
+        self.text = None
+        self.layout = None
+        self.bytes = 0
+
+def estimate_page_bytes(text, layout):
+    # Rough memory of a page's tokens and display list, used to bound the page cache
+    total = TOKEN_BYTES * len(text)
+    for tok in text:
+        total += len(tok.text) if isinstance(tok, Text) else len(tok.tag)
+    if layout is not None:
+        total += DISPLAY_ITEM_BYTES * len(layout.display_list)
+    return total
+
+class PageCache:
+    def __init__(self, max_bytes=PAGE_CACHE_SIZE):
+        # Pages navigated away from, least recently left first. Evicted pages keep their
+        # place in the history but drop their tokens and layout, and are fetched again
+        self.pages = collections.OrderedDict()  # Page -> None
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+
+    def add(self, page):
+        self.discard(page)
+        page.bytes = estimate_page_bytes(page.text, page.layout)
+        self.pages[page] = None
+        self.total_bytes += page.bytes
+        while self.total_bytes > self.max_bytes:
+            old, _ = self.pages.popitem(last=False)
+            self.total_bytes -= old.bytes
+            old.forget()
+            log(f"Page cache evicted {old.url}")
+
+    def take(self, page):
+        # Remove a page that is being shown again; returns False if it isn't cached
+        if page not in self.pages:
+            return False
+        self.discard(page)
+        return True
+
+    def discard(self, page):
+        if page in self.pages:
+            del self.pages[page]
+            self.total_bytes -= page.bytes
+
+class LoadCancelled(Exception):
+    pass
+
+class LoadTask:
+    def __init__(self, url, progressive, background=True):
+        # Fetches a URL off the UI thread; results are handed back through a queue
+        self.url = url
+        self.progressive = progressive
+        self.background = background  # Errors are shown on the page rather than raised
+        # ("chunk", text), ("done", body), ("error", exception) or ("cancelled", None). In the
+        # background the queue is bounded, so a fast source (a huge local file) waits for the
+        # UI instead of piling up decoded text
+        self.messages = queue.Queue(LOAD_QUEUE_SIZE if background else 0)
+        self.cancelled = threading.Event()
+
+    def run(self):
+        try:
+            body = self.url.request(on_chunk=self.on_chunk if self.progressive else None)  # Fetch content
+        except LoadCancelled:
+            self.send("cancelled", None)
+            return
+        except Exception as e:
+            self.send("error", e)
+            return
+        self.send("done", body)
+
+    def send(self, kind, value):
+        # Queue a message, waiting for room; returns False if the load is cancelled meanwhile
+        while not self.cancelled.is_set():
+            try:
+                self.messages.put((kind, value), timeout=LOAD_QUEUE_WAIT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def on_chunk(self, text):
+        if not self.send("chunk", text):
+            raise LoadCancelled()  # Abort the download
+
+    def cancel(self):
+        # A thread blocked in connect or recv can't be interrupted; it stops at the
+        # next chunk or timeout, and its results are ignored from now on
+        self.cancelled.set()
+
 class Browser:
     def __init__(self, text_left_to_right):
         # Initialize browser with text direction
         self.text_left_to_right = text_left_to_right
         self.window = tkinter.Tk()  # Create Tkinter window
+        if not isinstance(font_backend, TkFontBackend):
+            set_font_backend(TkFontBackend())  # Drawing on a canvas needs real Tk fonts
         self.scroll = 0  # Current scroll position
         self.content_height = 0  # Total content height
         self.width = 800  # Default window width
         self.height = 600  # Default window height
+        self.loading = False  # True while a page is being downloaded and painted progressively
+        self.display_list = DisplayList()
+        # Viewport index: the display list's y column, kept in order, is binary searched for the visible range
+        self.indexed_list = None  # Display list the index was built for
+        self.indexed_count = 0  # Leading items of the display list in the index
+        self.max_linespace = 0  # Tallest line, bounds how far above the viewport a visible item can start
+        self.drawn_items = {}  # Display list index -> canvas item kept between frames
+        self.drawn_scroll = 0  # Scroll position the retained items are drawn at
+        self.scrollbar_item = None
+        self.layouts = collections.OrderedDict()  # Layout width -> Layout of the current page, most recent last
+        self.layout = None  # Layout being shown, possibly still being laid out lazily
+        self.layout_job = None  # Idle callback continuing the shown layout
+        self.task = None  # LoadTask of the page being loaded
+        self.history = []  # Pages visited, oldest first
+        self.history_index = -1  # Position of the shown page in the history
+        self.page_cache = PageCache()
+        self.prefetch = PREFETCH_LINKS  # Fetch the links of each loaded page in the background
+        self.snapshot = None  # (snapshot file, local file) saved once the page being loaded is laid out
+        self.window.title("Vares Browser")
+        self.pending_resize = None  # Timer of a coalesced resize
         self.canvas = tkinter.Canvas(
             self.window,
             width=self.width,
@@ -569,6 +2891,9 @@ class Browser:
         self.window.bind("<Button-4>", self.scrollup)
         self.window.bind("<Button-5>", self.scrolldown)
         self.window.bind("<MouseWheel>", self.mouseWheelScroll)
+        self.window.bind("<Escape>", self.stop)
+        self.window.bind("<Alt-Left>", self.back)
+        self.window.bind("<Alt-Right>", self.forward)
 
     def mouseWheelScroll(self, e):
         # Handle mouse wheel scrolling
@@ -599,36 +2924,137 @@ class Browser:
         self.draw()
 
     def resize(self, event):
-        # Handle window resize
-        self.width = event.width
-        self.height = event.height
-        if hasattr(self, 'text'):
-            # Recalculate layout to check if scrollbar is needed
-            temp_biggest_y = Layout(self.text, self.width, self.text_left_to_right).biggest_y
-            temp_content_height = temp_biggest_y + VSTEP
-            if temp_content_height > self.height:
-                layout = Layout(self.text, self.width - SCROLLBAR_WIDTH, self.text_left_to_right)
-                self.display_list = layout.display_list
-                self.biggest_y = layout.biggest_y
-            else:
-                layout = Layout(self.text, self.width, self.text_left_to_right)
-                self.display_list = layout.display_list
-                self.biggest_y = layout.biggest_y
+        # Handle window resize; <Configure> fires continuously while the window
+        # edge is dragged, so only relayout once the events stop
+        if self.pending_resize is not None:
+            self.window.after_cancel(self.pending_resize)
+        self.pending_resize = self.window.after(RESIZE_DELAY, self.apply_resize, event.width, event.height)
+
+    def apply_resize(self, width, height):
+        self.pending_resize = None
+        if (width, height) == (self.width, self.height):
+            return
+        self.width = width
+        self.height = height
+        if hasattr(self, 'text') and not self.loading:
+            self.layout_page()
             self.draw()
 
+    def layout_page(self):
+        # Lay out self.text for the current size. A scrollbar is needed when the page
+        # doesn't fit at full width; the probe stops as soon as it overflows the
+        # window, so only one full layout is built either way
+        probe = self.layouts.get(self.width)
+        if probe is None:
+            probe = Layout(self.text, self.width, self.text_left_to_right, max_height=self.height)
+            if not probe.overflowed:
+                self.cache_layout(self.width, probe)
+        if probe.biggest_y + VSTEP > self.height:
+            width = self.width - SCROLLBAR_WIDTH
+            layout = self.layouts.get(width)
+            if layout is None:
+                # Only what's needed to draw the viewport; the rest is laid out when idle
+                layout = Layout(self.text, width, self.text_left_to_right, lazy_height=self.scroll + self.height + LAZY_LAYOUT_MARGIN, memoize=True)
+                self.cache_layout(width, layout)
+        else:
+            layout = probe
+        self.show_layout(layout)
+
+    def show_layout(self, layout):
+        # Make layout, one of self.layouts, the one drawn
+        self.layouts.move_to_end(layout.width)
+        self.layout = layout
+        self.display_list = layout.display_list
+        self.biggest_y = layout.estimated_height()
+        if self.layout_job is not None:
+            self.window.after_cancel(self.layout_job)
+            self.layout_job = None
+        if not layout.complete:
+            self.layout_job = self.window.after_idle(self.continue_layout, layout)
+
+    def continue_layout(self, layout):
+        # Lay out another slice of the shown page while the UI is idle
+        self.layout_job = None
+        if layout is not self.layout or layout.complete:
+            return
+        with tracer.span("layout", width=layout.width, lazy=True, idle=True):
+            layout.resume(deadline=time.perf_counter() + LAYOUT_SLICE)
+        self.biggest_y = layout.estimated_height()
+        if not layout.complete:
+            self.layout_job = self.window.after_idle(self.continue_layout, layout)
+        self.draw()  # The scrollbar follows the estimate
+
+    def cache_layout(self, width, layout):
+        self.layouts[width] = layout
+        while len(self.layouts) > LAYOUT_CACHE_SIZE:
+            self.layouts.popitem(last=False)
+
+    def update_index(self):
+        # Keep the y index in step with the display list, which may have been
+        # replaced (new layout) or extended (progressive load). Layout.flush appends
+        # lines in y order, so new items only need to be counted
+        display_list = self.display_list
+        if display_list is not self.indexed_list:
+            self.reset_canvas()
+            self.indexed_list = display_list
+        start = self.indexed_count
+        if len(display_list) == start:
+            return
+        self.indexed_count = len(display_list)
+        for fid in set(display_list.font_ids[start:]):
+            linespace = text_measurer.metrics(font_table[fid])["linespace"]
+            if linespace > self.max_linespace:
+                self.max_linespace = linespace
+
+    def reset_canvas(self):
+        # Forget every retained item and the index built for the old display list
+        self.canvas.delete("content")
+        self.drawn_items = {}
+        self.drawn_scroll = self.scroll
+        self.indexed_count = 0
+        self.max_linespace = 0
+
     def draw(self):
-        # Clear and redraw canvas
-        self.canvas.delete("all")
-        for item in self.display_list:
-            typ, x, y, val, font = item
+        # Redraw only what changed: retained items are moved by the scroll delta,
+        # items leaving the viewport are deleted and items entering it are created
+        if self.loading and self.streamed:
+            self.lay_out_streamed()  # Scrolled towards content received but not laid out
+        layout = self.layout
+        if layout is not None and not layout.complete and self.scroll + self.height + LAZY_LAYOUT_MARGIN > layout.biggest_y:
+            # Scrolled into content that isn't laid out yet
+            with tracer.span("layout", width=layout.width, lazy=True):
+                layout.resume(self.scroll + self.height + LAZY_LAYOUT_MARGIN)
+            self.biggest_y = layout.estimated_height()
+            self.scroll = min(self.scroll, max(0, self.biggest_y + VSTEP - self.height))
+        with tracer.span("draw", scroll=self.scroll) as args:
+            self.draw_viewport()
+            args["items"] = len(self.drawn_items)
+
+    def draw_viewport(self):
+        self.update_index()
+        top = self.scroll
+        bottom = self.scroll + self.height
+        display_list = self.display_list
+        first = bisect.bisect_left(display_list.ys, top - self.max_linespace, 0, self.indexed_count)
+        last = bisect.bisect_right(display_list.ys, bottom, 0, self.indexed_count)
+        ys = display_list.ys
+        font_ids = display_list.font_ids
+        visible = set()
+        for i in range(first, last):
             # Skip items outside visible area
-            if y > self.scroll + self.height:
+            if ys[i] + text_measurer.metrics(font_table[font_ids[i]])["linespace"] < top:
                 continue
-            if y + font.metrics("linespace") < self.scroll:
+            visible.add(i)
+        if self.drawn_scroll != self.scroll:
+            self.canvas.move("content", 0, self.drawn_scroll - self.scroll)
+            self.drawn_scroll = self.scroll
+        for i in [i for i in self.drawn_items if i not in visible]:
+            self.canvas.delete(self.drawn_items.pop(i))
+        for i in visible:
+            if i in self.drawn_items:
                 continue
-            if typ == "text":
-                # Draw text with specified font
-                self.canvas.create_text(x, y - self.scroll, text=val, font=font, anchor="nw" if not self.text_left_to_right else "nw")
+            # Draw text with specified font
+            self.drawn_items[i] = self.canvas.create_text(display_list.xs[i], ys[i] - self.scroll, text=display_list.words[i], font=font_table[font_ids[i]], anchor="nw", tags="content")
         # Draw scrollbar if content exceeds window height
         self.content_height = self.biggest_y + VSTEP
         if self.content_height > self.height:
@@ -640,36 +3066,266 @@ class Browser:
             thumb_height = (viewport_height / self.content_height) * track_height
             fraction = self.scroll / max_scroll if max_scroll > 0 else 0
             thumb_y = fraction * (track_height - thumb_height)
-            self.canvas.create_rectangle(track_x, thumb_y, track_x + SCROLLBAR_WIDTH, thumb_y + thumb_height, fill='black')
-
-    def load(self, url):
-        # Load and render URL content
-        global redirects_number
-        redirects_number = 0  # Reset redirect counter
-        body = url.request()  # Fetch content
-        self.text = lex(body, url.view_source, self.text_left_to_right)  # Parse content
-        # Calculate layout to determine scrollbar need
-        temp_biggest_y = Layout(self.text, self.width, self.text_left_to_right).biggest_y
-        temp_content_height = temp_biggest_y + VSTEP
-        if temp_content_height > self.height:
-            layout = Layout(self.text, self.width - SCROLLBAR_WIDTH, self.text_left_to_right)
-            self.display_list = layout.display_list
-            self.biggest_y = layout.biggest_y
+            if self.scrollbar_item is None:
+                self.scrollbar_item = self.canvas.create_rectangle(track_x, thumb_y, track_x + SCROLLBAR_WIDTH, thumb_y + thumb_height, fill='black')
+            else:
+                self.canvas.coords(self.scrollbar_item, track_x, thumb_y, track_x + SCROLLBAR_WIDTH, thumb_y + thumb_height)
+        elif self.scrollbar_item is not None:
+            self.canvas.delete(self.scrollbar_item)
+            self.scrollbar_item = None
+
+    def load(self, url, progressive=True, background=True, new_entry=True):
+        # Load and render URL content. In the background the fetch runs on a worker
+        # thread and the UI keeps handling events; otherwise this blocks until done.
+        # new_entry adds the URL to the history after the shown page, dropping the
+        # pages ahead of it; going back or forward reloads an existing entry instead
+        self.stop()
+        self.snapshot = None
+        if new_entry:
+            self.add_history_entry(url)
+        self.scroll = 0
+        task = LoadTask(url, progressive, background)
+        self.task = task
+        self.loading = True
+        self.window.title(f"Loading {url.scheme}://{url.host}{url.path}..." if url.host else "Loading...")
+        # Lex and lay out chunks as they arrive, painting the first screen early.
+        # Long pages are the ones that arrive in several chunks, so the partial
+        # layout leaves room for the scrollbar
+        self.lexer = Lexer(url.view_source, self.text_left_to_right, partial_text=True)
+        self.partial_layout = Layout([], self.width - SCROLLBAR_WIDTH, self.text_left_to_right, partial=True)
+        self.streamed = False
+        self.streamed_laid_out = 0  # Received tokens fed to the partial layout
+        if background:
+            threading.Thread(target=task.run, daemon=True).start()
+            self.window.after(LOAD_POLL_INTERVAL, self.poll_load, task)
         else:
-            layout = Layout(self.text, self.width, self.text_left_to_right)
-            self.display_list = layout.display_list
-            self.biggest_y = layout.biggest_y
+            task.run()
+            self.poll_load(task)
+
+    def add_history_entry(self, url):
+        # Make url the shown page of the history, dropping the pages ahead of the old one
+        self.leave_page()
+        for page in self.history[self.history_index + 1:]:
+            self.page_cache.discard(page)
+        del self.history[self.history_index + 1:]
+        self.history.append(Page(url))
+        self.history_index = len(self.history) - 1
+
+    def load_default(self, path):
+        # Show the local, static default page. Its first paint is drawn straight from a
+        # snapshot of its layout when one matches the file, the window size and the
+        # fonts; otherwise it's loaded as usual and the snapshot saved once laid out
+        url = URL(f"file:///{path}")
+        layout = load_snapshot(DEFAULT_SNAPSHOT_FILE, path, self.width, self.height, self.text_left_to_right)
+        if layout is None:
+            self.load(url)
+            self.snapshot = (DEFAULT_SNAPSHOT_FILE, path)
+            return
+        self.add_history_entry(url)
+        self.history[self.history_index].loaded = True
+        self.scroll = 0
+        self.text = lex(url.request(), url.view_source, self.text_left_to_right)  # Kept for relayouts on resize
+        self.layouts = collections.OrderedDict()
+        self.cache_layout(layout.width, layout)
+        self.show_layout(layout)
+        self.draw()
+
+    def poll_load(self, task):
+        # Apply everything the network thread has sent since the last poll
+        if task is not self.task:
+            return  # Cancelled or replaced by a newer load
+        changed = False
+        deadline = time.perf_counter() + LOAD_POLL_BUDGET
+        # A blocking load handles the whole queue now, so load() returns with the page
+        # shown or raises its error
+        while not task.background or time.perf_counter() < deadline:
+            try:
+                kind, value = task.messages.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "chunk":
+                if not self.streamed:
+                    self.streamed = True
+                    self.layout = None  # The partial layout is shown until the page is complete
+                    self.text = []
+                    self.display_list = self.partial_layout.display_list
+                    self.biggest_y = 0
+                with tracer.span("lex", chars=len(value), partial=True):
+                    tokens = self.lexer.feed(value)
+                self.text.extend(tokens)
+                self.lay_out_streamed()
+                changed = True
+            elif kind == "done":
+                self.history[self.history_index].loaded = True
+                if self.streamed:
+                    self.text.extend(self.lexer.close())
+                else:
+                    self.text = lex(value, task.url.view_source, self.text_left_to_right)  # Parse content
+                self.finish_load()
+                if self.snapshot is not None and self.layout.complete:
+                    save_snapshot(*self.snapshot, self.width, self.height, self.text_left_to_right, self.layout)
+                    self.snapshot = None
+                if self.prefetch:
+                    threading.Thread(target=prefetch_links, args=(list(self.text), task.url), daemon=True).start()
+                return
+            elif kind == "error":
+                if not task.background:
+                    self.task = None
+                    self.loading = False
+                    self.window.title("Vares Browser")
+                    raise value
+                # Show the error instead of the page, or after what was already received
+                print(f"Error loading page: {value}", file=sys.stderr)
+                if self.streamed:
+                    self.text.extend(self.lexer.close())
+                else:
+                    self.text = lex(f"Error loading page: {value}")
+                self.finish_load()
+                return
+            else:
+                return
+        if changed:
+            self.draw()
+        self.window.after(LOAD_POLL_INTERVAL, self.poll_load, task)
+
+    def lay_out_streamed(self):
+        # Feed received tokens to the partial layout only down to just below the
+        # viewport, so a huge document doesn't build its whole display list while it
+        # streams in; scrolling lays out more, and once loaded the lazy layout takes over
+        layout = self.partial_layout
+        limit = self.scroll + self.height + LAZY_LAYOUT_MARGIN
+        start = self.streamed_laid_out
+        if start == len(self.text) or layout.biggest_y > limit:
+            return
+        with tracer.span("layout", partial=True) as args:
+            while self.streamed_laid_out < len(self.text) and layout.biggest_y <= limit:
+                layout.feed(self.text[self.streamed_laid_out:self.streamed_laid_out + 1])
+                self.streamed_laid_out += 1
+            args["tokens"] = self.streamed_laid_out - start
+        self.biggest_y = layout.biggest_y
+
+    def finish_load(self):
+        # Calculate layout, with a scrollbar if needed
+        self.task = None
+        self.loading = False
+        self.window.title("Vares Browser")
+        if hasattr(self, 'text'):
+            self.layouts = collections.OrderedDict()  # Cached layouts belong to the previous page, which may keep one
+            self.layout_page()
+            self.draw()
+
+    def stop(self, e=None):
+        # Cancel the load in progress, keeping whatever was already shown
+        if self.task is None:
+            return
+        self.task.cancel()
+        self.task = None
+        self.loading = False
+        self.window.title("Vares Browser")
+        if self.streamed:
+            self.text.extend(self.lexer.close())
+            self.layouts = collections.OrderedDict()
+            self.layout_page()
+            self.draw()
+
+    def leave_page(self):
+        # Keep the shown page's tokens, layout and scroll position for going back to it.
+        # Only the layout in use is kept; other widths are rebuilt from the tokens
+        if not 0 <= self.history_index < len(self.history):
+            return
+        page = self.history[self.history_index]
+        if not page.loaded or self.layout is None:
+            return  # Failed or stopped loads are fetched again
+        page.text = self.text
+        page.layout = self.layout
+        page.size = (self.width, self.height)
+        page.scroll = self.scroll
+        self.page_cache.add(page)
+
+    def back(self, e=None):
+        self.go(self.history_index - 1)
+
+    def forward(self, e=None):
+        self.go(self.history_index + 1)
+
+    def go(self, index):
+        # Show the history entry at index, from the page cache when it's still there
+        if not 0 <= index < len(self.history) or index == self.history_index:
+            return
+        self.stop()
+        self.leave_page()
+        self.history_index = index
+        page = self.history[index]
+        if not self.page_cache.take(page):
+            self.load(page.url, new_entry=False)
+            return
+        self.text = page.text
+        self.layouts = collections.OrderedDict()
+        if page.size == (self.width, self.height):
+            self.layouts[page.layout.width] = page.layout
+            self.show_layout(page.layout)
+        else:
+            self.layout_page()  # Resized since: lay out the kept tokens again
+        self.scroll = min(page.scroll, max(0, self.biggest_y + VSTEP - self.height))
         self.draw()
 
 if __name__ == "__main__":
     # Main entry point
-    if len(sys.argv) <= 1:
+    if len(sys.argv) > 1 and sys.argv[1] == "--fetch":
+        # Headless batch mode: python Browser.py --fetch [--per-host N] URL... (or a file with one URL per line)
+        args = sys.argv[2:]
+        per_host = MAX_CONNECTIONS_PER_HOST
+        if args[:1] == ["--per-host"]:
+            per_host = int(args[1])
+            args = args[2:]
+        urls = []
+        for arg in args:
+            if "://" in arg or arg.startswith("data:"):
+                urls.append(arg)
+            else:
+                with open(arg, "r", encoding="utf8") as f:
+                    urls.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+        results = fetch_batch(urls, per_host)
+        sys.exit(1 if any(result.error for result in results) else 0)
+    elif len(sys.argv) > 1 and sys.argv[1] == "--render":
+        # Headless batch rendering: python Browser.py --render [--size WxH] [--processes N]
+        # [--output FILE] [--list FILE] URL-or-file..., one JSON line per page
+        args = sys.argv[2:]
+        width, height = 800, 600
+        processes = None
+        output_path = "-"
+        sources = []
+        while args:
+            if args[0] == "--size":
+                width, height = (int(n) for n in args[1].split("x"))
+                args = args[2:]
+            elif args[0] == "--processes":
+                processes = int(args[1])
+                args = args[2:]
+            elif args[0] == "--output":
+                output_path = args[1]
+                args = args[2:]
+            elif args[0] == "--list":
+                # One URL or file per line
+                with open(args[1], "r", encoding="utf8") as f:
+                    sources.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+                args = args[2:]
+            else:
+                sources.append(args[0])
+                args = args[1:]
+        if output_path == "-":
+            failed = render_batch(sources, sys.stdout, width, height, processes, report=sys.stderr)
+        else:
+            with open(output_path, "w", encoding="utf8") as output:
+                failed = render_batch(sources, output, width, height, processes)
+        sys.exit(1 if failed else 0)
+    elif len(sys.argv) <= 1:
         # Load default HTML file if no URL provided
         default_file = os.path.join(os.path.dirname(__file__), "Default.html")
-        Browser(False).load(URL(f"file:///{default_file}"))
+        Browser(False).load_default(default_file)
         tkinter.mainloop()
     else:
         # Load URL from command-line argument
         url = URL(sys.argv[1])
         Browser(url.right_to_left_text).load(url)
-        tkinter.mainloop()
\ No newline at end of file
+        tkinter.mainloop()
@@ -0,0 +1,40 @@
+# Tests for the keep-alive connection pool
+import os
+import socket
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("VARES_FONT_BACKEND", "headless")
+
+import Browser
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        # Two local servers, so the pool sees two hosts
+        self.servers = []
+        for _ in range(2):
+            server = socket.socket()
+            server.bind(("127.0.0.1", 0))
+            server.listen()
+            self.servers.append(server)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def test_idle_sockets_of_other_hosts_are_closed(self):
+        pool = Browser.ConnectionPool(idle_timeout=0.05)
+        first, second = [server.getsockname()[1] for server in self.servers]
+        s, reused = pool.acquire("http", "127.0.0.1", first)
+        pool.release(s)
+        time.sleep(0.1)
+        other, reused = pool.acquire("http", "127.0.0.1", second)
+        self.assertEqual(s.fileno(), -1)  # Closed, though its host wasn't asked for again
+        self.assertNotIn(("http", "127.0.0.1", first), pool.idle)
+        pool.release(other)
+        self.assertIn(("http", "127.0.0.1", second), pool.idle)
+
+if __name__ == "__main__":
+    unittest.main()
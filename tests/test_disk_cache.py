@@ -0,0 +1,87 @@
+# Tests for the on-disk response cache
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("VARES_FONT_BACKEND", "headless")
+
+import Browser
+
+def key(path):
+    return ("http", "example.org", 80, path)
+
+def response(size=100):
+    return Browser.CachedResponse(b"x" * size, None)
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = os.path.join(self.directory, "index.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_index_is_written_on_flush(self):
+        cache = Browser.DiskCache(self.directory)
+        cache.put(key("/a"), response())
+        cache.put(key("/b"), response())
+        self.assertIsNotNone(cache.get(key("/a")))
+        self.assertFalse(os.path.exists(self.index))  # Hits and stores only mark it dirty
+        self.assertIsNotNone(cache.flush_timer)
+        cache.flush()
+        self.assertIsNone(cache.flush_timer)
+        self.assertFalse(cache.dirty)
+        reloaded = Browser.DiskCache(self.directory)
+        self.assertIsNotNone(reloaded.get(key("/b")))
+        self.assertEqual(list(reloaded.entries), [key("/a"), key("/b")])  # LRU order kept
+        reloaded.flush()
+
+    def test_eviction_writes_index_right_away(self):
+        cache = Browser.DiskCache(self.directory, max_bytes=250)
+        cache.put(key("/a"), response())
+        cache.put(key("/b"), response())
+        cache.put(key("/c"), response())
+        reloaded = Browser.DiskCache(self.directory)
+        reloaded.load()
+        self.assertEqual(list(reloaded.entries), [key("/b"), key("/c")])
+        self.assertFalse(os.path.exists(cache.body_path(key("/a"))))
+        cache.flush()
+
+    def test_processes_sharing_the_directory_keep_each_others_entries(self):
+        first = Browser.DiskCache(self.directory)
+        second = Browser.DiskCache(self.directory)
+        first.put(key("/a"), response())
+        first.put(key("/gone"), response())
+        first.flush()
+        second.put(key("/b"), response())
+        second.flush()
+        first.delete(key("/gone"))
+        first.put(key("/c"), response())
+        first.flush()
+        reloaded = Browser.DiskCache(self.directory)
+        reloaded.load()
+        self.assertEqual(set(reloaded.entries), {key("/a"), key("/b"), key("/c")})
+        self.assertEqual(reloaded.total_bytes, 300)
+
+    def test_load_deletes_old_unlisted_bodies(self):
+        cache = Browser.DiskCache(self.directory)
+        cache.put(key("/a"), response())
+        cache.flush()
+        old = os.path.join(self.directory, "0" * 40)
+        new = os.path.join(self.directory, "1" * 40)
+        for path in (old, new):
+            with open(path, "wb") as f:
+                f.write(b"body")
+        past = time.time() - Browser.DISK_CACHE_ORPHAN_AGE - 1
+        os.utime(old, (past, past))
+        Browser.DiskCache(self.directory).load()
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))  # Maybe not indexed yet by the process writing it
+        self.assertTrue(os.path.exists(cache.body_path(key("/a"))))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+# Tests for the asyncio batch fetcher, against a local server
+import asyncio
+import http.server
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("VARES_FONT_BACKEND", "headless")
+
+import Browser
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.startswith("/huge"):
+            # Announces far more than it sends, then waits for the test to end
+            self.send_response(200)
+            self.send_header("Content-Length", str(10 ** 12))
+            self.end_headers()
+            self.wfile.write(b"x" * 5000)
+            self.wfile.flush()
+            self.server.finished.wait()
+            self.close_connection = True
+            return
+        body = b"<p>page</p>" * 100
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FetchBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.finished = threading.Event()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        Browser.cached_responses.clear()
+
+    def tearDown(self):
+        self.server.finished.set()
+        self.server.shutdown()
+        self.server.server_close()
+        Browser.cached_responses.clear()
+
+    def test_waiting_for_a_slot_across_runs(self):
+        # URLs beyond max_concurrency wait on the semaphore, in two event loops in a row
+        fetcher = Browser.AsyncFetcher(per_host=2, max_concurrency=2)
+        for run in range(2):
+            Browser.cached_responses.clear()
+            results = asyncio.run(fetcher.fetch_all([f"{self.base}/page{run}/{i}" for i in range(20)]))
+            self.assertEqual([result.error for result in results], [None] * 20)
+            self.assertEqual({result.status for result in results}, {200})
+
+    def test_announced_size_is_checked_while_reading(self):
+        max_size = Browser.MAX_BODY_SIZE
+        Browser.MAX_BODY_SIZE = 1000
+        try:
+            results = asyncio.run(Browser.AsyncFetcher().fetch_all([f"{self.base}/huge"]))
+        finally:
+            Browser.MAX_BODY_SIZE = max_size
+        # Before the rest of the announced size arrives, which it never does
+        self.assertIn("exceeds maximum size", results[0].error)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+# Tests for loading file:// URLs
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("VARES_FONT_BACKEND", "headless")
+
+import Browser
+
+class FileURLTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".html")
+        with os.fdopen(fd, "wb") as f:
+            f.write("<p>olá</p>".encode("utf8") * 1000)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_streamed_load_can_be_cancelled(self):
+        def on_chunk(text):
+            raise Browser.LoadCancelled()
+        with self.assertRaises(Browser.LoadCancelled):
+            Browser.URL(f"file://{self.path}").request(on_chunk=on_chunk)
+
+    def test_read_errors_become_value_errors(self):
+        with open(self.path, "wb") as f:
+            f.write(b"\xff\xfe invalid utf8")
+        with self.assertRaises(ValueError):
+            Browser.URL(f"file://{self.path}").request()
+        with self.assertRaises(ValueError):
+            Browser.URL(f"file://{self.path}.missing").request()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+# Tests for Layout's display lists
+import gc
+import os
+import sys
+import tracemalloc
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("VARES_FONT_BACKEND", "headless")
+
+import Browser
+
+# Paragraphs with raised superscripts, including lines holding nothing else
+PAGE = "".join(
+    f"<p>word {i} x<sup>2</sup> and <b>bold</b> <small>small</small> text {'more ' * (i % 40)}</p>"
+    + ("<p><sup>only superscript</sup></p>" if i % 7 == 0 else "")
+    for i in range(400)
+)
+
+class DisplayListOrderTest(unittest.TestCase):
+    def assert_sorted(self, display_list):
+        ys = display_list.ys
+        self.assertTrue(all(a <= b for a, b in zip(ys, ys[1:])), "y column out of order")
+
+    def test_full_layout_is_sorted(self):
+        tokens = Browser.lex(PAGE)
+        for width in (788, 300):
+            for right_to_left in (False, True):
+                with self.subTest(width=width, right_to_left=right_to_left):
+                    self.assert_sorted(Browser.Layout(tokens, width, right_to_left).display_list)
+
+    def test_lazy_and_streamed_layouts_are_sorted(self):
+        tokens = Browser.lex(PAGE)
+        layout = Browser.Layout(tokens, 788, False, lazy_height=600)
+        while not layout.resume(layout.biggest_y + 300):
+            self.assert_sorted(layout.display_list)
+        self.assert_sorted(layout.display_list)
+        lexer = Browser.Lexer(partial_text=True)
+        partial = Browser.Layout([], 788, False, partial=True)
+        for i in range(0, len(PAGE), 1000):
+            partial.feed(lexer.feed(PAGE[i:i + 1000]))
+            self.assert_sorted(partial.display_list)
+
+    def test_superscript_stays_within_its_line(self):
+        layout = Browser.Layout(Browser.lex("<p>first line</p><p><sup>raised</sup></p>"), 788, False)
+        ys = layout.display_list.ys
+        self.assertLess(ys[1], ys[2])  # "line" of the first paragraph is above "raised"
+
+def items(layout):
+    display_list = layout.display_list
+    return list(zip(display_list.xs, display_list.ys, display_list.font_ids, display_list.words)), layout.biggest_y
+
+class BlockMemoTest(unittest.TestCase):
+    def setUp(self):
+        Browser.block_cache.clear()
+
+    def tearDown(self):
+        Browser.block_cache.clear()
+
+    def test_one_off_layout_records_nothing(self):
+        Browser.Layout(Browser.lex(PAGE), 788, False)
+        self.assertEqual(len(Browser.block_cache.entries), 0)
+
+    def test_memoized_relayout_matches_fresh_layout(self):
+        tokens = Browser.lex(PAGE)
+        fresh = items(Browser.Layout(tokens, 788, False))
+        first = Browser.Layout(tokens, 788, False, memoize=True)
+        self.assertEqual(items(first), fresh)
+        self.assertGreater(len(Browser.block_cache.entries), 0)
+        self.assertEqual(items(Browser.Layout(tokens, 788, False, memoize=True)), fresh)
+        # An edited paragraph is laid out again, the blocks around it are reused
+        edited = list(tokens)
+        middle = next(i for i in range(len(edited) // 2, len(edited)) if isinstance(edited[i], Browser.Text))
+        edited[middle] = Browser.Text(edited[middle].text + " edited " * 30)
+        self.assertEqual(items(Browser.Layout(edited, 788, False, memoize=True)), items(Browser.Layout(edited, 788, False)))
+        lazy = Browser.Layout(tokens, 788, False, lazy_height=600, memoize=True)
+        while not lazy.resume(lazy.biggest_y + 300):
+            pass
+        self.assertEqual(items(lazy), fresh)
+
+class MemoryTest(unittest.TestCase):
+    def test_bytes_per_token_and_word(self):
+        # The compact tokens and columnar display list, measured like Benchmark.py's
+        # memory results; estimate_page_bytes relies on the same figures
+        html = PAGE * 4
+        Browser.Layout(Browser.lex(html), 788, False)  # Warm the measure cache so it isn't counted
+        Browser.block_cache.clear()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            start = tracemalloc.get_traced_memory()[0]
+            tokens = Browser.lex(html)
+            lexed = tracemalloc.get_traced_memory()[0]
+            layout = Browser.Layout(tokens, 788, False)
+            laid_out = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        self.assertLess((lexed - start) / len(tokens), Browser.TOKEN_BYTES * 1.25)
+        self.assertLess((laid_out - lexed) / len(layout.display_list), Browser.DISPLAY_ITEM_BYTES * 1.25)
+
+def stream(text, right_to_left=False, view_source=False, chunk=4096):
+    # Tokens of text fed in chunks to a streaming lexer, and how many came before close()
+    lexer = Browser.Lexer(view_source, right_to_left, partial_text=True)
+    tokens = []
+    for i in range(0, len(text), chunk):
+        tokens.extend(lexer.feed(text[i:i + chunk]))
+    early = len(tokens)
+    return tokens + lexer.close(), early
+
+class StreamedTextTest(unittest.TestCase):
+    def assert_streams_like_whole(self, text, right_to_left=False, view_source=False):
+        tokens, early = stream(text, right_to_left, view_source)
+        self.assertGreater(early, 1)  # Text was emitted before the end of the document
+        whole = Browser.Layout(Browser.lex(text, view_source, right_to_left), 788, right_to_left)
+        self.assertEqual(items(Browser.Layout(tokens, 788, right_to_left)), items(whole))
+
+    def test_lines_without_spaces_are_cut_at_line_breaks(self):
+        csv = "".join(f"{i},field,{i * 7},x\n" for i in range(20000))
+        self.assert_streams_like_whole(csv)
+        self.assert_streams_like_whole(csv, right_to_left=True)
+        self.assert_streams_like_whole("<pre>" + csv.replace("\n", "\n\n") + "</pre>", view_source=True)
+
+    def test_centered_title_is_not_cut(self):
+        title = "<h1 class=\"title\">" + "heading words\n" * 2000 + "</h1>"
+        tokens, early = stream(title + "<p>" + "body words\n" * 2000 + "</p>")
+        self.assertIn(title[18:-5], [token.text for token in tokens if isinstance(token, Browser.Text)])
+
+    def test_text_without_cuts_is_capped(self):
+        tokens, early = stream("x" * (Browser.PARTIAL_TEXT_LIMIT * 3))
+        self.assertGreater(early, 1)
+        self.assertLessEqual(max(len(token.text) for token in tokens), Browser.PARTIAL_TEXT_LIMIT + 4096)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+# Compatibility tests for the regex lexer: its tokens must match the old character by
+# character lexer, apart from the documented entity differences.
+#   python -m pytest tests   (or python -m unittest discover tests)
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("VARES_FONT_BACKEND", "headless")
+
+import Browser
+
+class ReferenceLexer:
+    # The lexer as it was before the regex rewrite, kept verbatim apart from producing
+    # (kind, text) pairs
+    def __init__(self, view_source=False, right_to_left=False):
+        self.view_source = view_source
+        self.right_to_left = right_to_left
+        self.out = []
+        self.buffer = ""
+        self.in_tag = False
+        self.entity = None
+        self.entities = {"&lt;": "<", "&gt;": ">"}
+
+    def feed(self, body):
+        if self.view_source:
+            body = body.replace("<", "&lt;").replace(">", "&gt;")
+        i = 0
+        if self.entity is not None:
+            i = self.scan_entity(body, i)
+        while i < len(body):
+            c = body[i]
+            if c == "<":
+                self.in_tag = True
+                if self.buffer:
+                    self.emit("Text", self.buffer)
+                    self.buffer = ""
+                i += 1
+            elif c == ">":
+                self.in_tag = False
+                self.emit("Tag", self.buffer)
+                self.buffer = ""
+                i += 1
+            elif not self.in_tag and c == "&":
+                self.entity = "&"
+                i = self.scan_entity(body, i + 1)
+            else:
+                self.buffer += c
+                i += 1
+
+    def scan_entity(self, body, i):
+        while i < len(body) and body[i] != ";" and len(self.entity) < 5:
+            self.entity += body[i]
+            i += 1
+        if i == len(body):
+            return i
+        if body[i] == ";":
+            self.entity += ";"
+            i += 1
+            self.buffer += self.entities.get(self.entity, self.entity)
+        else:
+            self.buffer += self.entity
+        self.entity = None
+        return i
+
+    def emit(self, kind, text):
+        if self.right_to_left and kind == "Text":
+            text = "\n".join(line[::-1] for line in text.split("\n"))
+        self.out.append((kind, text))
+
+    def close(self):
+        if self.entity is not None:
+            self.buffer += self.entity
+            self.entity = None
+        if not self.in_tag and self.buffer:
+            self.emit("Text", self.buffer)
+        self.buffer = ""
+        return self.out
+
+def reference_lex(body, view_source=False, right_to_left=False):
+    lexer = ReferenceLexer(view_source, right_to_left)
+    lexer.feed(body)
+    return lexer.close()
+
+def pairs(tokens):
+    return [("Text", token.text) if isinstance(token, Browser.Text) else ("Tag", token.tag) for token in tokens]
+
+def lex_chunks(chunks, view_source=False, right_to_left=False):
+    # Feed the chunks one by one to an incremental lexer
+    lexer = Browser.Lexer(view_source, right_to_left)
+    tokens = []
+    for chunk in chunks:
+        tokens.extend(lexer.feed(chunk))
+    return pairs(tokens + lexer.close())
+
+# Documents both lexers must tokenize the same way
+DOCUMENTS = [
+    "",
+    "plain text",
+    "<p>Hello <b>world</b></p>",
+    "<!DOCTYPE html><html><head><title>T</title></head><body><h1 class=\"title\">Hi</h1></body></html>",
+    "<p>line one\nline two</p>\n<br>\n<p>after</p>",
+    "a &lt;b&gt; c &lt;&gt;",
+    "unknown &foo; and &bar; kept",
+    "<a href=\"x?a=1&b=2\">link</a>",
+    "<!-- a comment with <b> inside -->text",
+    "<p>unclosed <b",
+    "text > stray > closers",
+    "<<double>> <a<b>",
+    "<>empty tag",
+    "<p>  spaces   between  </p>",
+    "<sup>up</sup><small>small</small><big>big</big>",
+    "ends with &lt;",
+    "mixed &lt;p&gt; and <i>tags</i> &gt;",
+]
+
+class LexCompatibilityTest(unittest.TestCase):
+    def test_documents_match_reference(self):
+        for body in DOCUMENTS:
+            # Entities the old lexer decoded in view-source are shown verbatim now, see
+            # test_view_source_is_verbatim
+            for view_source in (False, True) if "&lt;" not in body and "&gt;" not in body else (False,):
+                for right_to_left in (False, True):
+                    with self.subTest(body=body, view_source=view_source, right_to_left=right_to_left):
+                        self.assertEqual(pairs(Browser.lex(body, view_source, right_to_left)), reference_lex(body, view_source, right_to_left))
+
+    def test_every_chunk_boundary(self):
+        # Split each document at every position into two chunks
+        for body in DOCUMENTS:
+            want = reference_lex(body)
+            for i in range(len(body) + 1):
+                with self.subTest(body=body, split=i):
+                    self.assertEqual(lex_chunks([body[:i], body[i:]]), want)
+
+    def test_single_character_chunks(self):
+        for body in DOCUMENTS:
+            for right_to_left in (False, True):
+                with self.subTest(body=body, right_to_left=right_to_left):
+                    self.assertEqual(lex_chunks(list(body), right_to_left=right_to_left), reference_lex(body, right_to_left=right_to_left))
+
+    def test_split_inside_tag(self):
+        self.assertEqual(lex_chunks(["<p>a <b cla", "ss=\"x\">b</", "b></p>"]), [("Tag", "p"), ("Text", "a "), ("Tag", "b class=\"x\""), ("Text", "b"), ("Tag", "/b"), ("Tag", "/p")])
+
+    def test_split_inside_entity(self):
+        self.assertEqual(lex_chunks(["1 &l", "t; 2 &", "gt", "; 3"]), [("Text", "1 < 2 > 3")])
+        self.assertEqual(lex_chunks(["&amp", ";&#6", "5;&#x", "42;"]), [("Text", "&AB")])
+
+    def test_split_inside_comment(self):
+        body = "<!-- note <b> -->after"
+        self.assertEqual(lex_chunks(["<!-- no", "te <b", "> -->af", "ter"]), reference_lex(body))
+
+class EntityDifferenceTest(unittest.TestCase):
+    # The documented differences from the old lexer
+
+    def test_all_named_entities_decoded(self):
+        self.assertEqual(pairs(Browser.lex("a&amp;b&nbsp;c&copy;&eacute;")), [("Text", "a&b\xa0c\xa9\xe9")])
+        self.assertEqual(reference_lex("a&amp;b"), [("Text", "a&amp;b")])
+
+    def test_numeric_entities_decoded(self):
+        self.assertEqual(pairs(Browser.lex("&#65;&#x42;&#X43;&#x1F600;")), [("Text", "ABC\U0001F600")])
+        self.assertEqual(reference_lex("&#65;"), [("Text", "&#65;")])
+
+    def test_long_entity_names(self):
+        # The old lexer gave up on entities longer than 5 characters
+        self.assertEqual(pairs(Browser.lex("&hellip;&rarr;")), [("Text", "…→")])
+        self.assertEqual(reference_lex("&hellip;"), [("Text", "&hellip;")])
+
+    def test_unknown_entities_kept(self):
+        self.assertEqual(pairs(Browser.lex("&nosuchentity; &#xZZ;")), [("Text", "&nosuchentity; &#xZZ;")])
+
+    def test_stray_ampersand_is_text(self):
+        # The old lexer swallowed up to four characters after a stray &, tags included
+        self.assertEqual(pairs(Browser.lex("a & <b>b</b>")), [("Text", "a & "), ("Tag", "b"), ("Text", "b"), ("Tag", "/b")])
+        self.assertEqual(reference_lex("a & <b>b</b>"), [("Text", "a & <b>b"), ("Tag", "/b")])
+
+    def test_view_source_is_verbatim(self):
+        # The old lexer escaped the source and decoded it back, so &lt; showed as <
+        self.assertEqual(pairs(Browser.lex("<p>&lt;</p>", view_source=True)), [("Text", "<p>&lt;</p>")])
+        self.assertEqual(reference_lex("<p>&lt;</p>", view_source=True), [("Text", "<p><</p>")])
+
+if __name__ == "__main__":
+    unittest.main()
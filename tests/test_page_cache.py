@@ -0,0 +1,46 @@
+# Tests for the history page cache
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("VARES_FONT_BACKEND", "headless")
+
+import Browser
+
+def cached_page(url):
+    page = Browser.Page(Browser.URL(url))
+    page.text = Browser.lex("<p>some text</p>")
+    page.layout = Browser.Layout(page.text, 800, False)
+    return page
+
+class PageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.verbose = Browser.VERBOSE
+        Browser.VERBOSE = True  # Eviction is logged
+
+    def tearDown(self):
+        Browser.VERBOSE = self.verbose
+
+    def test_evicts_every_url_kind(self):
+        urls = ["about:blank", "data:text/html,<p>hi</p>", "file:///tmp/page.html", "view-source:http://example.org/a", "http://example.org/"]
+        pages = [cached_page(url) for url in urls]
+        cache = Browser.PageCache(max_bytes=Browser.estimate_page_bytes(pages[0].text, pages[0].layout))  # Room for one page
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            for page in pages:
+                cache.add(page)
+        self.assertEqual(list(cache.pages), [pages[-1]])
+        self.assertIsNone(pages[0].text)
+        self.assertEqual(stderr.getvalue().splitlines(), [
+            "Page cache evicted about:blank",
+            "Page cache evicted data:text/html,...",
+            "Page cache evicted file:///tmp/page.html",
+            "Page cache evicted view-source:http://example.org/a",
+        ])
+        self.assertEqual(str(Browser.URL("rlt:https://example.org")), "https://example.org/")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+# Tests for picking the links a page prefetches
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("VARES_FONT_BACKEND", "headless")
+
+import Browser
+
+class LinkTargetsTest(unittest.TestCase):
+    def test_unparsable_links_are_skipped(self):
+        tokens = Browser.lex(
+            '<link rel="preconnect" href="http://h:abc/"><link rel="preconnect" href="https://cdn.example.org/">'
+            '<a href="http://h:abc/">bad port</a><a href="/next">next</a><a href="http://other.example.org/">other</a>'
+        )
+        urls, origins = Browser.link_targets(tokens, Browser.URL("http://example.org/page"))
+        self.assertEqual(urls, ["http://example.org/next", "http://other.example.org/"])
+        self.assertEqual(origins, [("https", "cdn.example.org", 443)])
+
+    def test_pages_without_scheme_prefetch_nothing(self):
+        requests = []
+        request_many = Browser.URL.request_many
+        Browser.URL.request_many = lambda self, paths, *args, **kwargs: requests.append(paths) or []
+        try:
+            tokens = Browser.lex('<a href="http://example.org/">link</a>')
+            for base in ("about:blank", "data:text/html,<p>hi</p>"):
+                Browser.prefetch_links(tokens, Browser.URL(base))
+        finally:
+            Browser.URL.request_many = request_many
+        self.assertEqual(requests, [])
+
+if __name__ == "__main__":
+    unittest.main()